@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+from datetime import datetime, timezone
+from sqlalchemy import select, func, union_all
+from db_models import User, Budget, Expense, BudgetSummary
+
+
+def count_budgets(connection, user_id):
+    return connection.execute(select(func.count()).where(Budget.__table__.c.user_id == user_id)).scalar_one()
+
+
+def budget_tokens(connection, condition):
+
+    # The ciphertexts of the budgets matching condition and of their expenses and summaries, in a single
+    # query. The database deletes the expenses and summaries along with a budget (ON DELETE CASCADE) without
+    # returning them, so these are read before the delete to remove them from the decrypt cache after it
+    budgets, expenses, summaries = Budget.__table__, Expense.__table__, BudgetSummary.__table__
+    ids = select(budgets.c.id).where(condition)
+    return connection.execute(union_all(
+        select(budgets.c.budget.label("token")).where(condition),
+        select(budgets.c.result).where(condition),
+        select(budgets.c.packed).where(condition),
+        select(expenses.c.amount).where(expenses.c.budget_id.in_(ids)),
+        select(summaries.c.total).where(summaries.c.budget_id.in_(ids))
+        )).scalars().all()
+
+
+def delete_account_data(engine, user_id, chunk_size=500, pause=0.05, cache=None):
+
+    # Delete a users budgets a chunk at a time, each chunk in its own short transaction so locks are only
+    # held briefly, then the user. Expenses and summaries are deleted by the database (ON DELETE CASCADE),
+    # their ciphertexts are removed from cache (a DecryptCache) once a chunk is committed.
+    # Returns the number of budgets deleted
+    budgets = Budget.__table__
+    deleted = 0
+    while True:
+        tokens = []
+        with engine.begin() as connection:
+            ids = connection.execute(
+                select(budgets.c.id).where(budgets.c.user_id == user_id).limit(chunk_size)
+                ).scalars().all()
+            if not ids:
+                connection.execute(User.__table__.delete().where(User.__table__.c.id == user_id))
+                return deleted
+            if cache is not None:
+                tokens = budget_tokens(connection, budgets.c.id.in_(ids))
+            connection.execute(budgets.delete().where(budgets.c.id.in_(ids)))
+            deleted += len(ids)
+        if cache is not None:
+            cache.invalidate(tokens)
+
+        # Give other transactions a chance between chunks
+        time.sleep(pause)
+
+
+def mark_deleted(connection, user_id):
+
+    # The account stops working straight away, its username and email are freed up and the
+    # password can't match anything, while its data is deleted in the background. The placeholder
+    # username and email are ones the register form rejects (an @ in the username, an email without
+    # a top level domain), so they can't collide with an account registered in the meantime
+    users = User.__table__
+    connection.execute(
+        users.update().where(users.c.id == user_id).values(
+            username=f"deleted@{user_id}",
+            username_lower=f"deleted@{user_id}",
+            email=f"deleted-{user_id}@invalid",
+            password="!",
+            deleted_at=datetime.now(timezone.utc)
+            )
+        )
+
+
+def delete_in_background(engine, user_id, chunk_size=500, pause=0.05, cache=None):
+
+    # Start deleting a (marked) account in a background thread. If the process stops before it's done,
+    # purge_deleted_accounts picks up where it left off
+    def run():
+        try:
+            deleted = delete_account_data(engine, user_id, chunk_size, pause, cache)
+            logging.getLogger(__name__).info("Deleted account %s with %s budgets", user_id, deleted)
+        except Exception:
+            logging.getLogger(__name__).exception("Could not delete account %s, flask purge-deleted-accounts will retry", user_id)
+
+    thread = threading.Thread(target=run, name=f"delete-account-{user_id}", daemon=True)
+    thread.start()
+    return thread
+
+
+def purge_deleted_accounts(engine, chunk_size=500, pause=0.05):
+
+    # Finish deleting every account that was marked as deleted, returns the number of accounts
+    with engine.connect() as connection:
+        user_ids = connection.execute(
+            select(User.__table__.c.id).where(User.__table__.c.deleted_at.is_not(None))
+            ).scalars().all()
+
+    for user_id in user_ids:
+        delete_account_data(engine, user_id, chunk_size, pause)
+
+    return len(user_ids)
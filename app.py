@@ -1,44 +1,120 @@
 import os
 import re
+import io
+import csv
+import json
 
-from flask import Flask, render_template, request, session, redirect, flash, url_for, jsonify, abort
+from flask import render_template, request, session, redirect, flash, url_for, jsonify, abort, make_response, \
+    stream_with_context
 from flask_session import Session
 from db_models import *
-from werkzeug.security import check_password_hash, generate_password_hash
-from helpers import login_required, form_data_error, escape_chars, encrypt_data, decrypt_data
-from validator_collection import checkers
+from factory import create_app
+from helpers import login_required, BudgetValidator, escape_chars, encrypt_data, encrypt_batch, decrypt_batch, DecryptCache, \
+    encrypt_packed, decrypt_packed, encode_cursor, decode_cursor, diff_expenses, \
+    summarize_expenses, read_ndjson, read_csv, convert_import_form, import_form_error, EXPORT_COLUMNS
+from fragment_cache import FragmentCache
+from session_backends import init_sessions, purge_expired_sessions
+from revisions import budget_state, plan_revisions, revision_list_query, revision_chain_query, rebuild_revision
+from account_deletion import budget_tokens, count_budgets, mark_deleted, delete_in_background, purge_deleted_accounts
+from passwords import PasswordHasher, PasswordPoolBusy
+from replicas import REPLICA, read_only
+from pool_stats import PoolStats
+from instrumentation import Instrumentation
+from static_assets import StaticAssets
 from sqlalchemy.exc import IntegrityError, NoResultFound
-from datetime import timedelta
-from cryptography.fernet import Fernet
-from dotenv import load_dotenv
+from datetime import timedelta, timezone
+from cryptography.fernet import Fernet, MultiFernet
+from markupsafe import Markup
 
 
-# Load environment variables from .env file
-load_dotenv()
+# The app with its database configured from the environment variables (see factory.py)
+app = create_app()
 
-app = Flask(__name__)
+# Static files get content hashed URLs and are cached for good, served precompressed when build_static.py
+# made .br/.gz copies. HTML and JSON responses of at least GZIP_MIN_SIZE bytes are gzipped. Registered
+# before the other hooks in this file so the compression runs after them
+STATIC_ASSETS = StaticAssets(
+    app, gzip_min_size=int(os.getenv("GZIP_MIN_SIZE", 1024)), gzip_level=int(os.getenv("GZIP_LEVEL", 6))
+    )
 
-# https://flask-sqlalchemy.palletsprojects.com/en/3.1.x/quickstart/#configure-the-extension
-# configure SQLAlchemy db URI
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-# Display database queries and messages in the CLI
-# app.config["SQLALCHEMY_ECHO"] = True
-
-# Configure flask-session
+# Configure sessions, SESSION_BACKEND picks where they're stored: "cached" (database, only written
+# when a session changes, default), "cookie" (encrypted cookie, nothing stored) or "sqlalchemy"
+# (flask-session, reads and writes the database on every request)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cached")
 app.config["SESSION_TYPE"] = "sqlalchemy"
 app.config["SESSION_PERMANENT"] = True
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=1)
 app.config["SESSION_SQLALCHEMY"] = db
 
-# Bind SQLAlchemy to the Flask app instance
-db.init_app(app)
-
-# Initialize session with app
-Session(app)
+# Record checkout latency, connections in use and churn, shown on /internal/stats
+POOL_STATS = PoolStats()
+REPLICA_POOL_STATS = PoolStats()
+with app.app_context():
+    POOL_STATS.attach(db.engine)
+    if REPLICA in db.engines:
+        REPLICA_POOL_STATS.attach(db.engines[REPLICA])
+
+# Time SQL, encryption/decryption and template rendering of every request. METRICS=1 enables /metrics,
+# SERVER_TIMING=1 adds a Server-Timing header, requests slower than SLOW_REQUEST_MS are logged with their statements
+app.config["METRICS"] = os.getenv("METRICS") == "1"
+INSTRUMENTATION = Instrumentation(
+    app, server_timing=os.getenv("SERVER_TIMING") == "1", slow_ms=int(os.getenv("SLOW_REQUEST_MS", 500))
+    )
+with app.app_context():
+    for engine in db.engines.values():
+        INSTRUMENTATION.attach_engine(engine)
 
 # Get and set the secret key for encryption/decryption
-KEY = Fernet(os.getenv("SECRET_KEY").encode())
+# New values are always encrypted with SECRET_KEY, values encrypted with any of the comma separated
+# OLD_SECRET_KEYS can still be decrypted, so the key can be rotated without downtime (see rotate_keys.py)
+KEY = MultiFernet(
+    [Fernet(os.getenv("SECRET_KEY").encode())] +
+    [Fernet(key.strip().encode()) for key in os.getenv("OLD_SECRET_KEYS", "").split(",") if key.strip()]
+    )
+
+# Initialize session with app
+if SESSION_BACKEND == "sqlalchemy":
+    Session(app)
+else:
+    init_sessions(app, db, SESSION_BACKEND, KEY)
+
+# How batches of values are encrypted/decrypted: "serial", "thread" or "process" pool
+CRYPTO_MODE = os.getenv("CRYPTO_MODE", "thread")
+
+# In-process cache of decrypted values keyed by ciphertext, bounded to DECRYPT_CACHE_BYTES
+DECRYPT_CACHE = DecryptCache(int(os.getenv("DECRYPT_CACHE_BYTES", 8 * 1024 * 1024)))
+
+# How new and updated budgets store their expenses: "rows" (an Expense row per expense) or
+# "packed" (all expenses serialized and encrypted as a single blob on the budget)
+BUDGET_STORAGE = os.getenv("BUDGET_STORAGE", "rows")
+
+# Cache of rendered page fragments, "simple" (in-process), "filesystem" (in FRAGMENT_CACHE_DIR) or "null".
+# Entries expire after FRAGMENT_CACHE_TIMEOUT seconds, at most FRAGMENT_CACHE_THRESHOLD are kept
+FRAGMENT_CACHE = FragmentCache(
+    os.getenv("FRAGMENT_CACHE", "simple"),
+    timeout=int(os.getenv("FRAGMENT_CACHE_TIMEOUT", 300)),
+    threshold=int(os.getenv("FRAGMENT_CACHE_THRESHOLD", 500)),
+    cache_dir=os.getenv("FRAGMENT_CACHE_DIR", os.path.join(app.instance_path, "fragments"))
+    )
+
+# Password hashing runs on a pool of PASSWORD_WORKERS ("process", "thread" or "inline" with PASSWORD_POOL),
+# with at most PASSWORD_QUEUE more waiting, past that requests get a 503 instead of piling up.
+# Stored hashes that don't match PASSWORD_HASH_METHOD (e.g. "scrypt:32768:8:1" or
+# "pbkdf2:sha256:600000") are rehashed when the user logs in
+HASHER = PasswordHasher(
+    os.getenv("PASSWORD_HASH_METHOD", "scrypt"),
+    mode=os.getenv("PASSWORD_POOL", "process"),
+    workers=int(os.getenv("PASSWORD_WORKERS", 2)),
+    max_queue=int(os.getenv("PASSWORD_QUEUE", 8)),
+    timeout=int(os.getenv("PASSWORD_TIMEOUT", 10))
+    )
+
+# Serve the budget routes (index, budget, create, update, delete) with async views on an AsyncSession
+# when ASYNC_MODE is set. ASYNC_DATABASE_URL defaults to DATABASE_URL with the async driver (aiosqlite/asyncpg)
+ASYNC_MODE = os.getenv("ASYNC_MODE") == "1"
+
+# Expose cache and connection pool statistics on /internal/stats, disabled unless INTERNAL_STATS is set
+app.config["INTERNAL_STATS"] = os.getenv("INTERNAL_STATS") == "1"
 
 # Valid categories for budgeting
 CATEGORIES = [
@@ -49,82 +125,644 @@ CATEGORIES = [
 # Max character length allowed for budget name and expense names
 MAX_LEN = 100
 
+# Most expenses a single budget can have, checked before anything else in the form
+MAX_EXPENSES = int(os.getenv("MAX_EXPENSES", 500))
+
+# Checks the create/update form and imported budgets, the schema is compiled once when the first budget is checked
+BUDGET_VALIDATOR = BudgetValidator(CATEGORIES, MAX_LEN, MAX_EXPENSES)
+
+# Number of budgets listed per page on the index page, and the most the API will return at once
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Accounts with more budgets than this are deleted in the background, ACCOUNT_DELETE_CHUNK budgets per transaction
+BACKGROUND_DELETE_THRESHOLD = int(os.getenv("BACKGROUND_DELETE_THRESHOLD", 1000))
+ACCOUNT_DELETE_CHUNK = int(os.getenv("ACCOUNT_DELETE_CHUNK", 500))
+
+# Every REVISION_CHECKPOINT-th revision of a budget is stored in full, the ones in between as the changes
+# since the previous revision, so rebuilding any revision takes at most REVISION_CHECKPOINT - 1 deltas
+REVISION_CHECKPOINT = int(os.getenv("REVISION_CHECKPOINT", 10))
+
+# Budgets per chunk when exporting (each chunk is decrypted in one batch), and per transaction when importing
+EXPORT_CHUNK = 100
+IMPORT_BATCH = 100
+
+
+def budget_page_query(user_id, after=None, limit=PAGE_SIZE):
+
+    # Keyset pagination, ordered by most recent with id to break ties. Starting after the
+    # cursor position means every page is a single index range scan, no matter how deep.
+    # One extra row is selected to know whether there's another page
+    query = (
+        db.select(Budget.id, Budget.name, Budget.timestamp)
+        .where(Budget.user_id == user_id)
+        .order_by(Budget.timestamp.desc(), Budget.id.desc())
+        .limit(limit + 1)
+        )
+    if after:
+        timestamp, id = decode_cursor(after)
+        query = query.where(
+            (Budget.timestamp < timestamp) | ((Budget.timestamp == timestamp) & (Budget.id < id))
+            )
+
+    return query
+
+
+def split_page(budgets, limit=PAGE_SIZE):
+
+    # Drop the extra row, if there was one the last budget on the page is where the next one starts
+    next_cursor = None
+    if len(budgets) > limit:
+        budgets = budgets[:limit]
+        next_cursor = encode_cursor(budgets[-1].timestamp, budgets[-1].id)
+
+    return budgets, next_cursor
+
+
+def budget_page(user_id, after=None, limit=PAGE_SIZE):
+    budgets = db.session.execute(budget_page_query(user_id, after, limit)).all()
+    return split_page(budgets, limit)
+
+
+def insert_budget(user_id, name, total, result, packed, expenses):
+
+    # Bulk write path for a new budget, values are expected to be encrypted already and expenses is
+    # a list of ((category, expense, amount), encrypted amount). The budget id comes back from
+    # the INSERT itself (RETURNING), then every expense goes in with a single executemany which
+    # SQLAlchemy batches into multi-row INSERTs (insertmanyvalues), no per-object unit of work
+    budget_id = db.session.execute(
+        db.insert(Budget)
+        .values(user_id=user_id, budget=total, result=result, name=name, packed=packed)
+        .returning(Budget.id)
+        ).scalar_one()
+
+    if expenses:
+        db.session.execute(
+            db.insert(Expense),
+            [
+                {"budget_id": budget_id, "category": category, "note": expense, "amount": amount}
+                for (category, expense, _), amount in expenses
+            ]
+            )
+
+    return budget_id
+
+
+def save_budget(user_id, budget, expenses):
+
+    # Encrypt a new budget (already validated) and add it with its expenses and category summaries,
+    # as part of the current transaction. Returns the id of the new budget
+
+    # In packed mode the expenses are stored as a single token on the budget, otherwise
+    # flatten them into (category, expense, amount) rows
+    packed = BUDGET_STORAGE == "packed"
+    rows = [] if packed else [
+        (category, expense, expenses[category][expense]) 
+        for category in expenses.keys() for expense in expenses[category]
+        ]
+
+    # Encrypt the budget values and all of the expense amounts in one batch
+    encrypted = encrypt_batch(
+        [budget.get("total"), budget.get("result")] + [amount for _, _, amount in rows], KEY, CRYPTO_MODE,
+        cache=DECRYPT_CACHE
+        )
+
+    budget_id = insert_budget(
+        user_id, 
+        budget.get("name"), 
+        encrypted[0], 
+        encrypted[1],
+        encrypt_packed(expenses, KEY, DECRYPT_CACHE) if packed else None,
+        list(zip(rows, encrypted[2:]))
+        )
+
+    # A new budget only has summaries to add, they go in with a single executemany like the expenses
+    # instead of one INSERT ... RETURNING per category
+    adds, _, _ = plan_summaries(budget_id, expenses)
+    if adds:
+        db.session.execute(db.insert(BudgetSummary), [
+            {"budget_id": budget_id, "category": row.category, "total": row.total, "count": row.count} for row in adds
+            ])
+
+    return budget_id
+
+
+def plan_summaries(budget_id, expenses, existing=()):
+
+    # Work out how the summary rows of a budget have to change to match its expenses.
+    # Only categories where the total or count changed get re-encrypted, existing rows are updated
+    # in place. Returns (rows to add, rows to delete, tokens that were replaced) so the tokens
+    # can be removed from the decrypt cache
+    summary = summarize_expenses(expenses)
+    current = {row.category: row for row in existing}
+    old_totals = decrypt_batch([row.total for row in existing], KEY, CRYPTO_MODE, cache=DECRYPT_CACHE)
+    old = {row.category: (total, row.count) for row, total in zip(existing, old_totals)}
+
+    changed = [category for category, (total, count) in summary.items() if old.get(category) != (str(total), count)]
+    encrypted = encrypt_batch([summary[category][0] for category in changed], KEY, CRYPTO_MODE, cache=DECRYPT_CACHE)
+
+    adds, deletes, stale = [], [], []
+    for category, total in zip(changed, encrypted):
+        if category in current:
+            stale.append(current[category].total)
+            current[category].total = total
+            current[category].count = summary[category][1]
+        else:
+            adds.append(BudgetSummary(
+                budget_id=budget_id, category=category, total=total, count=summary[category][1]
+                ))
+
+    # Remove categories that no longer have any expenses
+    for category, row in current.items():
+        if category not in summary:
+            stale.append(row.total)
+            deletes.append(row)
+
+    return adds, deletes, stale
+
+
+def write_summaries(budget_id, expenses, existing=()):
+
+    # Bring the summary rows of a budget in line with its expenses, as part of the same transaction.
+    # Returns the tokens that were replaced so they can be removed from the decrypt cache
+    adds, deletes, stale = plan_summaries(budget_id, expenses, existing)
+    db.session.add_all(adds)
+    for row in deletes:
+        db.session.delete(row)
+
+    return stale
+
+
+def budget_version_query(id):
+
+    # A single primary key lookup of what's needed to answer a conditional request, nothing is decrypted
+    return db.select(Budget.user_id, Budget.nonce, Budget.version, Budget.timestamp, Budget.updated_at).where(Budget.id == id)
+
+
+def version_info(id, row):
+
+    # Returns (owner, etag, last modified) from a budget_version_query row, or None if the budget doesn't exist
+    if row is None:
+        return None
+
+    # SQLite hands back naive datetimes, they're stored as UTC
+    last_modified = row.updated_at or row.timestamp
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+    # Budgets created before the nonce column was added don't have one, ids are only reused for new budgets
+    etag = f"{id}-{row.nonce}-{row.version}" if row.nonce else f"{id}-{row.version}"
+    return row.user_id, etag, last_modified
+
+
+def budget_version(id):
+    return version_info(id, db.session.execute(budget_version_query(id)).one_or_none())
+
+
+def not_modified(etag, last_modified):
+
+    # Whether the copy the client has cached is still current, If-None-Match takes precedence
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+
+    return False
+
+
+def cache_headers(response, etag, last_modified):
+
+    # Let the browser keep a copy, but it has to revalidate it on every use
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def budget_json(budget):
+
+    # Build a dictionary with the budget information, its categories with expense, cost key value pairs
+    # and the expense ids. Raises TypeError or ValueError if the values can't be decrypted and converted
+
+    # Packed budgets store all of their expenses in a single token instead of Expense rows
+    expenses = [] if budget.packed else budget.expenses
+    
+    # Decrypt the budget values and every expense amount together in one batch
+    decrypted = decrypt_batch(
+        [budget.budget, budget.result] + [expense.amount for expense in expenses], KEY, CRYPTO_MODE,
+        cache=DECRYPT_CACHE
+        )
+
+    # Convert to float in order to compare against form data
+    # (budget.budget is optional so it may not contain binary data)
+    json = {
+        "info": {
+            "name": budget.name,
+            "total": float(decrypted[0]) if budget.budget else budget.budget,
+            "result": float(decrypted[1]),
+            "id": budget.id
+            },
+        "categories": {},
+        "ids": {}
+    }
+
+    # Decode all of the packed expenses in one pass
+    if budget.packed:
+        json["categories"] = decrypt_packed(budget.packed, KEY, DECRYPT_CACHE)
+        if json["categories"] is None:
+            raise ValueError("Packed expenses could not be decrypted")
+
+    # Add categories and expense, cost key value pairs to categories part of the dictionary
+    for expense, amount in zip(expenses, decrypted[2:]):
+        if expense.category not in json["categories"].keys():
+            json["categories"][expense.category] = {}
+            json["ids"][expense.category] = {}
+
+        # Keep the expense id so that updates can tell which rows changed
+        json["ids"][expense.category][expense.note] = expense.id
+        json["categories"][expense.category][expense.note] = float(amount)
+
+    return json
+
+
+def update_budget(cur_budget, budget, expenses, ids=None):
+
+    # Apply a submitted form to a budget, its expenses and summaries have to be loaded. Only values
+    # that changed are re-encrypted, nothing is added to or deleted from the session here.
+    # Returns (rows to add, rows to delete, tokens that were replaced or deleted, revisions), revisions
+    # being the values to insert into the revision log for the new version (see revisions.py).
+    # Raises TypeError or ValueError if the current values can't be decrypted and converted
+
+    # Decrypt the current budget in order to compare against form data, and to work out the revision.
+    # The expense amounts decrypted here come from the decrypt cache when they're compared below
+    current = budget_json(cur_budget)
+    budget_total = current["info"]["total"]
+    budget_result = current["info"]["result"]
+
+    revisions = plan_revisions(
+        cur_budget, cur_budget.version, budget_state(current["info"], current["categories"]),
+        budget_state(budget, expenses), REVISION_CHECKPOINT, KEY
+        )
+
+    # Bump the version so cached copies of the budget are no longer valid
+    cur_budget.version = Budget.version + 1
+    cur_budget.updated_at = db.func.now()
+
+    # Update name, budget, result
+    if cur_budget.name != budget.get("name"):
+        cur_budget.name = budget.get("name")
+
+    adds, deletes, stale = [], [], []
+
+    if budget_total != budget.get("total"):
+        stale.append(cur_budget.budget)
+        cur_budget.budget = encrypt_data(budget.get("total"), KEY)
+
+    if budget_result != budget.get("result"):
+        stale.append(cur_budget.result)
+        cur_budget.result = encrypt_data(budget.get("result"), KEY)
+    
+    # In packed mode replace the packed token and remove any expense rows
+    if BUDGET_STORAGE == "packed":
+        for expense in cur_budget.expenses:
+            stale.append(expense.amount)
+            deletes.append(expense)
+        stale.append(cur_budget.packed)
+        cur_budget.packed = encrypt_packed(expenses, KEY, DECRYPT_CACHE)
+
+    # Otherwise only write the expense rows that actually changed
+    else:
+        if cur_budget.packed:
+            stale.append(cur_budget.packed)
+            cur_budget.packed = None
+
+        # Match the submitted expenses against the existing rows by the ids sent back by the client
+        matched, inserts, removed = diff_expenses(cur_budget.expenses, expenses, ids)
+
+        # Compare the decrypted amounts of matched rows, only changed amounts get re-encrypted. They're compared
+        # as numbers, an amount stored as "10" is unchanged when the form sends back 10.0
+        old_amounts = decrypt_batch([expense.amount for expense, _ in matched], KEY, CRYPTO_MODE, cache=DECRYPT_CACHE)
+        changed = [
+            (expense, amount) for (expense, (_, _, amount)), old in zip(matched, old_amounts)
+            if float(old) != float(amount)
+            ]
+        encrypted = encrypt_batch(
+            [amount for _, amount in changed] + [amount for _, _, amount in inserts], KEY, CRYPTO_MODE,
+            cache=DECRYPT_CACHE
+            )
+
+        # Rename or move matched expenses, the ORM only emits an UPDATE for attributes that changed
+        for expense, (category, note, _) in matched:
+            if expense.category != category:
+                expense.category = category
+            if expense.note != note:
+                expense.note = note
+
+        for (expense, _), amount in zip(changed, encrypted):
+            stale.append(expense.amount)
+            expense.amount = amount
+
+        # Expenses that were removed
+        for expense in removed:
+            stale.append(expense.amount)
+            deletes.append(expense)
+
+        # New expenses along with their encrypted amounts
+        for (category, expense, _), amount in zip(inserts, encrypted[len(changed):]):
+            adds.append(Expense(budget_id=cur_budget.id, category=category, note=expense, amount=amount))
+
+    # Update the per category totals in the same transaction
+    summary_adds, summary_deletes, summary_stale = plan_summaries(cur_budget.id, expenses, cur_budget.summaries)
+
+    return adds + summary_adds, deletes + summary_deletes, stale + summary_stale, revisions
+
+
+def export_budgets(user_id):
+
+    # Yield (budget, total, result, categories) for every budget of a user. Budgets are streamed from a
+    # server side cursor (yield_per) a chunk at a time, and the expenses of each chunk are loaded and
+    # decrypted in one batch, so memory use stays the same no matter how many budgets there are
+    budgets = db.session.execute(
+        db.select(Budget.id, Budget.name, Budget.budget, Budget.result, Budget.packed, Budget.timestamp)
+        .where(Budget.user_id == user_id)
+        .order_by(Budget.id)
+        .execution_options(yield_per=EXPORT_CHUNK)
+        )
+    for chunk in budgets.partitions():
+        expenses = db.session.execute(
+            db.select(Expense.budget_id, Expense.category, Expense.note, Expense.amount)
+            .where(Expense.budget_id.in_([budget.id for budget in chunk]))
+            .order_by(Expense.budget_id, Expense.id)
+            ).all()
+
+        # Exported values aren't put in the decrypt cache, they would only push out the ones in use
+        decrypted = decrypt_batch(
+            [value for budget in chunk for value in (budget.budget, budget.result)] + [expense.amount for expense in expenses],
+            KEY, CRYPTO_MODE
+            )
+        decrypted = [float(value) if value is not None else None for value in decrypted]
+
+        categories = {budget.id: {} for budget in chunk}
+        for expense, amount in zip(expenses, decrypted[2 * len(chunk):]):
+            categories[expense.budget_id].setdefault(expense.category, {})[expense.note] = amount
+
+        for i, budget in enumerate(chunk):
+            if budget.packed:
+                categories[budget.id] = decrypt_packed(budget.packed, KEY) or {}
+            yield budget, decrypted[2 * i], decrypted[2 * i + 1], categories[budget.id]
+
 
 @app.route("/")
 @login_required
+@read_only
 def index():
 
-    # Select all of the users budgets
-    budgets = db.session.execute(
-                                db.select(Budget)
-                                .where(Budget.user_id == session["user_id"])
-                                .group_by(Budget)
-                                .order_by(Budget.timestamp.desc())
-                                ).scalars().all()
+    def render():
+
+        # Select the first page of the users budgets, the rest are loaded from /api/budgets
+        budgets, next_cursor = budget_page(session["user_id"])
+        return render_template("fragments/index.html", budgets=budgets, next_cursor=next_cursor)
+
+    # The list only changes when the user writes something, which invalidates their fragments
+    fragment = FRAGMENT_CACHE.get_or_render(FRAGMENT_CACHE.key(session["user_id"], "index"), render)
    
-    return render_template("index.html", budgets=budgets)
+    return render_template("index.html", fragment=Markup(fragment))
+
+
+@app.route("/api/budgets")
+@login_required
+@read_only
+def api_budgets():
+
+    # Get the cursor and page size, the limit is clamped to a sensible range
+    after = request.args.get("after")
+    limit = min(max(request.args.get("limit", PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+    try:
+        budgets, next_cursor = budget_page(session["user_id"], after, limit)
+    except ValueError:
+        return jsonify({"response": "Invalid cursor"}), 400
+
+    return jsonify({
+        "budgets": [
+            {
+                "id": budget.id,
+                "name": budget.name,
+                "timestamp": budget.timestamp.isoformat(),
+                "date": budget.timestamp.strftime("%Y-%m-%d, %H:%M"),
+                "url": url_for("budget", id=budget.id)
+            }
+            for budget in budgets
+        ],
+        "next": next_cursor
+    })
 
 
 @app.route("/budget/<int:id>")
 @login_required
+@read_only
 def budget(id):
 
     error = None
 
-    # https://docs.sqlalchemy.org/en/20/tutorial/orm_related_objects.html#using-relationships-in-queries
-    # Select budget and expenses associated with it
-    try:
-        budget = db.session.execute(
-                                    db.select(Budget)
-                                    .join_from(Budget, Expense)
-                                    .where(Budget.id == id)
-                                    .group_by(Budget)
-                                    .order_by(Budget.timestamp.desc())
-                                    ).scalar_one()
-    except NoResultFound:
+    # Check whether the client already has the current version before loading anything else
+    version = budget_version(id)
+    if version is None:
         return abort(404)
+    user_id, etag, last_modified = version
     
     # Prevent other users from accessing current users budgets
-    if session["user_id"] != budget.user_id:
+    if session["user_id"] != user_id:
         return abort(401)
-    
-    # Decrypt and convert to float in order to compare against form data
+
+    # Pending flash messages have to be rendered, so the page can't come from the browser cache then
+    if not session.get("_flashes") and not_modified(etag, last_modified):
+        return cache_headers(app.response_class(status=304), etag, last_modified)
+
+    def render():
+
+        # Select the budget along with its expenses (none if the budget is packed)
+        budget = db.session.execute(
+            db.select(Budget).options(*load_encrypted(Budget.expenses)).where(Budget.id == id)
+            ).scalar_one()
+
+        # Decrypt the budget into the same structure that's used when creating a budget
+        json = budget_json(budget)
+        return render_template("fragments/budget.html", json=json, categories=CATEGORIES, max_len=MAX_LEN)
+
+    # The etag includes the version, so the fragment is only rendered again after the budget is updated.
+    # Last modified tells it apart from an earlier budget that had the same id and version
     try:
-        # If there's binary data to decrypt, decrypt it 
-        # (budget.budget is optional so it may not contain binary data)
-        if budget.budget:
-            budget_total = float(decrypt_data(budget.budget, KEY))
-        else:
-            budget_total = budget.budget
-        budget_result = float(decrypt_data(budget.result, KEY))
-    except ValueError:
+        fragment = FRAGMENT_CACHE.get_or_render(
+            FRAGMENT_CACHE.key(user_id, "budget", etag), render
+            )
+    except (TypeError, ValueError):
         error = "Budget could not be loaded, unable to convert values"
         flash(error)
         return redirect(url_for("index"))  
 
-    # Initialize a dictionary to store budget and expense information
-    json = {
-        "info": {
-            "name": budget.name,
-            "total": budget_total,
-            "result": budget_result,
-            "id": id
-            },
-        "categories": {}
-    }
+    response = make_response(render_template("budget.html", fragment=Markup(fragment)))
+    return cache_headers(response, etag, last_modified)
 
-    # Add categories and expense, cost key value pairs to categories part of the dictionary
-    for expense in budget.expenses:
-        if expense.category not in json["categories"].keys():
-            json["categories"][expense.category] = {}
+
+@app.route("/api/budget/<int:id>")
+@login_required
+@read_only
+def api_budget(id):
+
+    # Same checks as the budget page, unchanged budgets get a 304 without any decryption
+    version = budget_version(id)
+    if version is None:
+        return abort(404)
+    user_id, etag, last_modified = version
+
+    if session["user_id"] != user_id:
+        return abort(401)
+
+    if not_modified(etag, last_modified):
+        return cache_headers(app.response_class(status=304), etag, last_modified)
+
+    budget = db.session.execute(
+        db.select(Budget).options(*load_encrypted(Budget.expenses)).where(Budget.id == id)
+        ).scalar_one()
+
+    # Same structure that the budget page is rendered from
+    try:
+        json = budget_json(budget)
+    except (TypeError, ValueError):
+        return jsonify({"response": "Budget could not be loaded, unable to convert values"}), 500
+
+    return cache_headers(jsonify(json), etag, last_modified)
+
+
+@app.route("/api/budget/<int:id>/summary")
+@login_required
+@read_only
+def budget_summary(id):
+
+    # Select the budget along with its summary rows
+    try:
+        budget = db.session.execute(
+            db.select(Budget).options(*load_encrypted(Budget.summaries)).where(Budget.id == id)
+            ).scalar_one()
+    except NoResultFound:
+        return abort(404)
+    
+    # Prevent other users from accessing current users budgets
+    if session["user_id"] != budget.user_id:
+        return abort(401)
+
+    # Budgets saved before summaries existed get theirs from create_tables.py migrate. Until then, and for
+    # budgets without expenses, the totals are worked out from the expenses, nothing is written on a GET
+    if not budget.summaries:
+
+        # Loads the expenses into the budget that's already in the session
+        db.session.execute(db.select(Budget).options(*load_encrypted(Budget.expenses)).where(Budget.id == id))
         try:
-            json["categories"][expense.category][expense.note] = float(decrypt_data(expense.amount, KEY))
-        except ValueError:
-            error = "Budget could not be loaded, unable to convert values"
-            flash(error)
-            return redirect(url_for("index"))  
+            json = budget_json(budget)
+        except (TypeError, ValueError):
+            return jsonify({"response": "Budget could not be loaded, unable to convert values"}), 500
+        total, result = json["info"]["total"], json["info"]["result"]
+        categories = {
+            category: {"total": amount, "count": count}
+            for category, (amount, count) in summarize_expenses(json["categories"]).items()
+        }
+
+    else:
+
+        # A handful of decrypts, the budget values and one total per category
+        summaries = budget.summaries
+        decrypted = decrypt_batch(
+            [budget.budget, budget.result] + [summary.total for summary in summaries], KEY, CRYPTO_MODE,
+            cache=DECRYPT_CACHE
+            )
 
-    return render_template("budget.html", json=json, categories=CATEGORIES, max_len=MAX_LEN)
+        try:
+            total = float(decrypted[0]) if budget.budget else None
+            result = float(decrypted[1])
+            categories = {
+                summary.category: {"total": float(amount), "count": summary.count}
+                for summary, amount in zip(summaries, decrypted[2:])
+            }
+        except (TypeError, ValueError):
+            return jsonify({"response": "Budget could not be loaded, unable to convert values"}), 500
+
+    return jsonify({
+        "id": budget.id,
+        "total": total,
+        "result": result,
+        "remaining": round(total - result, 2) if total else None,
+        "categories": categories
+    })
+
+
+def owned_budget(id):
+
+    # None if the budget belongs to the current user, otherwise the status to abort with
+    version = budget_version(id)
+    if version is None:
+        return 404
+    if session["user_id"] != version[0]:
+        return 401
+    return None
+
+
+@app.route("/api/budget/<int:id>/revisions")
+@login_required
+@read_only
+def budget_revisions(id):
+
+    status = owned_budget(id)
+    if status is not None:
+        return abort(status)
+
+    # Listed without reading or decrypting the revisions themselves. Budgets that were never updated have none
+    revisions = db.session.execute(revision_list_query(id)).all()
+    return jsonify({
+        "revisions": [
+            {
+                "revision": revision.revision,
+                "checkpoint": revision.revision == revision.checkpoint,
+                "created": revision.created_at.isoformat(),
+                "size": revision.size,
+                "url": url_for("budget_revision", id=id, revision=revision.revision)
+            }
+            for revision in revisions
+        ]
+    })
+
+
+def load_revision(id, revision):
+
+    # The budget as it was at a revision, rebuilt from the checkpoint before it and the deltas since.
+    # Returns None if there's no such revision, raises ValueError if it can't be decrypted
+    rows = db.session.execute(revision_chain_query(id, revision)).all()
+    return rebuild_revision(rows, KEY)
+
+
+@app.route("/api/budget/<int:id>/revisions/<int:revision>")
+@login_required
+@read_only
+def budget_revision(id, revision):
+
+    status = owned_budget(id)
+    if status is not None:
+        return abort(status)
+
+    try:
+        state = load_revision(id, revision)
+    except ValueError:
+        return jsonify({"response": "Revision could not be loaded"}), 500
+    if state is None:
+        return abort(404)
+
+    # Same structure as /api/budget, without expense ids since the expenses may no longer exist
+    return jsonify({
+        "info": {"name": state["name"], "total": state["total"], "result": state["result"], "id": id, "revision": revision},
+        "categories": state["categories"]
+    })
 
 
 @app.route("/create", methods=["GET", "POST"])
@@ -135,62 +773,32 @@ def create():
 
         error = None
 
-        # Get the JSON object containing form data
+        # Get the JSON object containing form data, bodies over MAX_CONTENT_LENGTH are rejected before parsing
         form = request.json
 
+        # If something is wrong with the form, return the error message to display
+        error = BUDGET_VALIDATOR.error(form)
+        if error is not None:
+            return jsonify({"response": error})
+
         # Break it up into budget and expense data for convenience
         budget = form.get("info")
         expenses = form.get("categories")
 
-        # Check for errors in the form
-        error = form_data_error(form, CATEGORIES, MAX_LEN)
-
-        # Try to add the budget to the database
+        # Try to add the budget, its expenses and category summaries to the database
         try:
-            new_budget = Budget(
-                user_id=session["user_id"],
-                budget=encrypt_data(budget.get("total"), KEY),
-                result=encrypt_data(budget.get("result"), KEY),
-                name=budget.get("name")
-                )
-            db.session.add(new_budget)
-
-            # https://docs.sqlalchemy.org/en/20/tutorial/orm_data_manipulation.html#flushing
-            # Create new transaction and emit SQL, but transaction remains open until commit is called
+            save_budget(session["user_id"], budget, expenses)
             db.session.flush()
         except IntegrityError:
             db.session.rollback()
             error = "Budget could not be saved"
             return jsonify({"response": error})
 
-        # Loop through categories, and expenses inside them
-        for category in expenses.keys():
-            for expense in expenses[category]:
-                amount = expenses[category][expense]
-
-                # Try to add expense to database
-                try:
-                    new_expense = Expense(
-                        budget_id=new_budget.id,
-                        category=category,
-                        note=expense,
-                        amount=encrypt_data(amount, KEY)
-                    )
-                    db.session.add(new_expense)
-                except IntegrityError:
-                    db.session.rollback()
-                    error = "Data could not be saved"
-                    break
-
         # If there was no error, commit the transactions to the database
-        if error is None:
-            db.session.commit()
-            # return jsonify({"response": "Data submitted"})
-            return jsonify({"url": url_for("index")})
-        
-        # If something went wrong, return the error message to display
-        db.session.rollback()
-        return jsonify({"response": error})
+        db.session.commit()
+        FRAGMENT_CACHE.invalidate_user(session["user_id"])
+        # return jsonify({"response": "Data submitted"})
+        return jsonify({"url": url_for("index")})
 
     else:
         return render_template("create.html", categories=CATEGORIES, max_len=MAX_LEN)
@@ -202,81 +810,105 @@ def update():
 
     error = None
     
-    # Get the form data that was submitted
+    # Get the form data that was submitted, bodies over MAX_CONTENT_LENGTH are rejected before parsing
     form = request.json
 
+    # Check for errors in the form
+    error = BUDGET_VALIDATOR.error(form)
+    if error is not None:
+        return jsonify({"response": error})
+
     # Break it up into budget and expense data for convenience
     budget = form.get("info")
     expenses = form.get("categories")
 
-    # Check for errors in the form
-    error = form_data_error(form, CATEGORIES, MAX_LEN)
-
-    # Select budget by id and user_id
+    # Select budget by id and user_id, with the rows update_budget needs
     try:
         cur_budget = db.session.execute(
                 db.select(Budget)
+                .options(*load_encrypted(Budget.expenses, Budget.summaries))
                 .where((Budget.id == budget.get("id")) &
                     (Budget.user_id == session["user_id"])
                     )).scalar_one()
     except NoResultFound:
         error = "Budget could not be found"
+        return jsonify({"response": error})
 
-    # Decrypt and convert to float in order to compare against form data
     try:
-        if cur_budget.budget:
-            budget_total = float(decrypt_data(cur_budget.budget, KEY))
-        else:
-            budget_total = cur_budget.budget
-        budget_result = float(decrypt_data(cur_budget.result, KEY))
-    except ValueError:
+        adds, deletes, stale, revisions = update_budget(cur_budget, budget, expenses, form.get("ids"))
+    except (TypeError, ValueError):
+        db.session.rollback()
         error = "One or more values could not be processed as float"
+        return jsonify({"response": error})
 
-    # Update name, budget, result
-    if cur_budget.name != budget.get("name"):
-        cur_budget.name = budget.get("name")
+    db.session.add_all(adds)
+    for row in deletes:
+        db.session.delete(row)
+    db.session.execute(db.insert(BudgetRevision), revisions)
 
-    if budget_total != budget.get("total"):
-        cur_budget.budget = encrypt_data(budget.get("total"), KEY)
+    # Commit and send where to redirect since Flask redirect won't work when using fetch. The id is read
+    # first, after the commit it would reload the budget along with its expenses and summaries
+    budget_id = cur_budget.id
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        error = "Data could not be saved"
+        return jsonify({"response": error})
 
-    if budget_result != budget.get("result"):
-        cur_budget.result = encrypt_data(budget.get("result"), KEY)
-    
-    # Could have updated expenses if expense id was saved in the json, but seems unnecessary
-    # when there's not budget or expense history being stored
-   
-    # Delete expenses previous expenses (not committed yet)
-    for expense in cur_budget.expenses:
-        db.session.delete(expense)
-            
-    # Loop through categories, and expenses inside them
-    for category in expenses.keys():
-        for expense in expenses[category]:
-            amount = expenses[category][expense]
+    # Tokens that were replaced or deleted are removed from the decrypt cache
+    DECRYPT_CACHE.invalidate(stale)
+    FRAGMENT_CACHE.invalidate_user(session["user_id"])
+    return jsonify({"url": url_for("budget", id=budget_id)})
 
-            # Try to add expense to database
-            try:
-                new_expense = Expense(
-                    budget_id=cur_budget.id,
-                    category=category,
-                    note=expense,
-                    amount=encrypt_data(amount, KEY)
-                )
-                db.session.add(new_expense)
-            except IntegrityError:
-                db.session.rollback()
-                error = "Data could not be saved"
-                break
 
-    # If there was no error commit and send where to redirect since Flask redirect
-    # won't work when using fetch
-    if error is None:
+@app.route("/budget/<int:id>/revisions/<int:revision>/restore", methods=["POST"])
+@login_required
+def restore_revision(id, revision):
+
+    # Restoring is an update back to an earlier revision, it's added to the log as a new revision so
+    # nothing is lost and the restore itself can be undone
+    try:
+        cur_budget = db.session.execute(
+            db.select(Budget)
+            .options(*load_encrypted(Budget.expenses, Budget.summaries))
+            .where((Budget.id == id) & (Budget.user_id == session["user_id"]))
+            ).scalar_one()
+    except NoResultFound:
+        return jsonify({"response": "Budget could not be found"}), 404
+
+    try:
+        state = load_revision(id, revision)
+    except ValueError:
+        return jsonify({"response": "Revision could not be loaded"}), 500
+    if state is None:
+        return jsonify({"response": "Revision could not be found"}), 404
+
+    # Checked like the update form, the categories or limits may have changed since
+    budget = {"name": state["name"], "total": state["total"], "result": state["result"], "id": id}
+    error = BUDGET_VALIDATOR.error({"info": budget, "categories": state["categories"]})
+    if error is not None:
+        return jsonify({"response": error})
+
+    try:
+        adds, deletes, stale, revisions = update_budget(cur_budget, budget, state["categories"])
+    except (TypeError, ValueError):
+        db.session.rollback()
+        return jsonify({"response": "One or more values could not be processed as float"})
+
+    db.session.add_all(adds)
+    for row in deletes:
+        db.session.delete(row)
+    db.session.execute(db.insert(BudgetRevision), revisions)
+    try:
         db.session.commit()
-        return jsonify({"url": url_for("budget", id=cur_budget.id)})
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"response": "Data could not be saved"})
 
-    # If there was an error rollback changes and return an error response
-    db.session.rollback()
-    return jsonify({"response": error})
+    DECRYPT_CACHE.invalidate(stale)
+    FRAGMENT_CACHE.invalidate_user(session["user_id"])
+    return jsonify({"url": url_for("budget", id=id)})
 
 
 @app.route("/delete", methods=["POST"])
@@ -286,27 +918,136 @@ def delete():
     # Select the form input with name id
     id = request.form.get("id")
 
-    # Select the budget with the selected id, and make sure user_id matches
-    try:
-        budget = db.session.execute(
-                db.select(Budget)
-                .where((Budget.id == id) & 
-                (Budget.user_id == session["user_id"])
-                )).scalar_one()
-    except NoResultFound:
+    # Delete the budget with the selected id in a single statement, making sure user_id matches.
+    # Its expenses and summaries are deleted by the database (ON DELETE CASCADE), so the ciphertexts
+    # of all three are read first to remove them from the decrypt cache
+    owned = (Budget.id == id) & (Budget.user_id == session["user_id"])
+    tokens = budget_tokens(db.session.connection(), owned)
+    deleted = db.session.execute(db.delete(Budget).where(owned).returning(Budget.id)).one_or_none()
+    if deleted is None:
         flash("Budget was not found")
         return redirect("/")
 
-    # Delete the budget from the database
-    db.session.delete(budget)
     db.session.commit()
 
+    DECRYPT_CACHE.invalidate(tokens)
+    FRAGMENT_CACHE.invalidate_user(session["user_id"])
+
     # Redirect to show the new list of budgets
     return redirect("/")
 
 
+@app.route("/export")
+@login_required
+@read_only
+def export():
+
+    # Stream all of the users budgets as NDJSON (default, a budget per line in the same structure the
+    # create form sends) or CSV (?format=csv, a row per expense). The response is generated while it's sent
+    format = request.args.get("format", "ndjson")
+    user_id = session["user_id"]
+
+    if format == "csv":
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            for budget, total, result, categories in export_budgets(user_id):
+                for category, expenses in categories.items():
+                    for expense, amount in expenses.items():
+                        writer.writerow([
+                            budget.id, budget.name, "" if total is None else total, result,
+                            budget.timestamp.isoformat(), category, expense, amount
+                            ])
+
+                # Send the rows of each budget as soon as they're written
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        mimetype = "text/csv"
+
+    elif format == "ndjson":
+        def generate():
+            for budget, total, result, categories in export_budgets(user_id):
+                yield json.dumps({
+                    "info": {"name": budget.name, "total": total, "result": result},
+                    "categories": categories,
+                    "timestamp": budget.timestamp.isoformat()
+                    }) + "\n"
+        mimetype = "application/x-ndjson"
+
+    else:
+        return abort(404)
+
+    # The request context has to stay around while streaming, for the database session
+    response = app.response_class(stream_with_context(generate()), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=budgets.{format}"
+    return response
+
+
+@app.route("/import", methods=["POST"])
+@login_required
+def import_budgets():
+
+    error = None
+
+    # The file is an export, CSV if the name ends with .csv otherwise NDJSON
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        error = "Please choose a file to import"
+        flash(error)
+        return redirect(url_for("account"))
+
+    reader = read_csv if upload.filename.lower().endswith(".csv") else read_ndjson
+    lines = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+
+    # The file is read a budget at a time, twice. The first pass only validates, with the same rules
+    # as the create form, so nothing is saved unless the whole file is valid
+    try:
+        for number, form in reader(lines):
+            error = import_form_error(form, BUDGET_VALIDATOR)
+            if error is not None:
+                error = f"Line {number}: {error}"
+                break
+    except (ValueError, csv.Error) as e:
+        error = str(e)
+
+    if error is not None:
+        flash(error)
+        return redirect(url_for("account"))
+
+    # The second pass saves the budgets, committing every IMPORT_BATCH budgets to keep transactions bounded.
+    # The file is read again rather than keeping every budget in memory, so the numbers are converted again
+    # but the checks aren't repeated
+    lines.seek(0)
+    imported = 0
+    try:
+        for number, form in reader(lines):
+            form = convert_import_form(form)
+            save_budget(session["user_id"], form["info"], form["categories"])
+            imported += 1
+            if imported % IMPORT_BATCH == 0:
+                db.session.commit()
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        imported -= imported % IMPORT_BATCH
+        error = f"Line {number}: budget could not be saved, the import stopped after {imported} budgets"
+
+    if imported:
+        FRAGMENT_CACHE.invalidate_user(session["user_id"])
+
+    if error is not None:
+        flash(error)
+        return redirect(url_for("account"))
+
+    flash(f"Imported {imported} budgets")
+    return redirect(url_for("index"))
+
+
 @app.route("/account")
 @login_required
+@read_only
 def account():
 
     error = None
@@ -343,13 +1084,23 @@ def delete_account():
         error = "User not found"
 
     # Ensure the correct password is provided before deleting
-    if not check_password_hash(USER.password, password):
+    if error is None and not HASHER.verify(USER.password, password):
         error = "Incorrect password"
 
-    # If there are no errors delete the users account
+    # If there are no errors delete the users account, in a single statement since the database deletes
+    # their budgets, expenses and summaries (ON DELETE CASCADE). Large accounts are marked as deleted
+    # and deleted in chunks in the background instead, so no single transaction holds locks for long
     if error is None:
-        db.session.delete(USER)
-        db.session.commit()
+        if count_budgets(db.session.connection(), USER.id) > BACKGROUND_DELETE_THRESHOLD:
+            mark_deleted(db.session.connection(), USER.id)
+            db.session.commit()
+            delete_in_background(db.engine, USER.id, ACCOUNT_DELETE_CHUNK, cache=DECRYPT_CACHE)
+        else:
+            tokens = budget_tokens(db.session.connection(), Budget.user_id == USER.id)
+            db.session.execute(db.delete(User).where(User.id == USER.id))
+            db.session.commit()
+            DECRYPT_CACHE.invalidate(tokens)
+        FRAGMENT_CACHE.invalidate_user(USER.id)
 
         # Clear the session before flashing message, since it's stored in the session
         session.clear()
@@ -392,14 +1143,14 @@ def change_password():
         error = "User not found"
 
     # Make sure the correct old password was entered
-    if not check_password_hash(USER.password, old):
+    if not HASHER.verify(USER.password, old):
         error = "Incorrect old password"
 
     # If there were no errors update the password
     if error is None:
 
         # Update password in db
-        USER.password = generate_password_hash(new)
+        USER.password = HASHER.hash(new)
         db.session.commit()
 
         flash("Password has been changed")
@@ -435,8 +1186,13 @@ def login():
             USER = db.session.execute(db.select(User).where((User.username_lower==username) | (User.email==username))).scalar_one()
             
             # Check password
-            if not check_password_hash(USER.password, password):
+            if not HASHER.verify(USER.password, password):
                 error = "Incorrect password"
+
+            # Upgrade hashes made with an older method or cost, while the password is known
+            elif HASHER.needs_rehash(USER.password):
+                USER.password = HASHER.hash(password)
+                db.session.commit()
                 
         except NoResultFound:
             error = "Invalid username or email"
@@ -460,7 +1216,10 @@ def login():
 def register():
 
     if request.method == "POST":
-        
+
+        # Imported on the first registration rather than at startup, validator_collection is slow to import
+        from validator_collection import checkers
+
         # Get user input
         username = request.form.get("username")
         email = request.form.get("email")
@@ -476,6 +1235,11 @@ def register():
         # Error checking form input
         if not username:
             error = "Please provide a username"
+
+        # Users log in with their username or email, so a username can't look like an email.
+        # This also keeps the usernames of deleted accounts (see account_deletion.py) free
+        elif "@" in username:
+            error = "Username can't contain @"
         elif not password:
             error = "Please enter a password"
         elif password != confirm:
@@ -494,7 +1258,7 @@ def register():
                 USER = User(
                     username=username, 
                     username_lower=username.lower(), 
-                    password=generate_password_hash(password), 
+                    password=HASHER.hash(password), 
                     email=email.lower()
                     )
                 db.session.add(USER)
@@ -519,6 +1283,47 @@ def register():
     return render_template("register.html")
 
 
+@app.route("/internal/stats")
+def internal_stats():
+
+    # Only available when enabled in the config, so it isn't exposed by accident
+    if not app.config["INTERNAL_STATS"]:
+        return abort(404)
+
+    return jsonify({
+        "decrypt_cache": DECRYPT_CACHE.stats(),
+        "fragment_cache": FRAGMENT_CACHE.stats(),
+        "pool": POOL_STATS.stats(),
+        "replica_pool": REPLICA_POOL_STATS.stats() if REPLICA_POOL_STATS.pool else None
+    })
+
+
+@app.route("/metrics")
+def metrics():
+
+    # Per route request metrics in the Prometheus text format, only available when enabled in the config
+    if not app.config["METRICS"]:
+        return abort(404)
+
+    return app.response_class(INSTRUMENTATION.metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.cli.command("purge-sessions")
+def purge_sessions():
+
+    # Delete expired sessions in batches, e.g. from a cron job: flask purge-sessions
+    deleted = purge_expired_sessions(db.engine, app.config.get("SESSION_CLEANUP_BATCH", 1000))
+    print(f"Deleted {deleted} expired sessions")
+
+
+@app.cli.command("purge-deleted-accounts")
+def purge_deleted():
+
+    # Finish deleting accounts that were being deleted in the background when the app stopped
+    purged = purge_deleted_accounts(db.engine, ACCOUNT_DELETE_CHUNK)
+    print(f"Deleted {purged} accounts")
+
+
 # https://flask.palletsprojects.com/en/3.0.x/errorhandling/#custom-error-pages
 # Client error responses
 @app.errorhandler(404)
@@ -541,7 +1346,33 @@ def unauthorized(e):
     return render_template("400.html", code=401, message="Unauthorized", top=top, bottom=bottom), 401
 
 
+@app.errorhandler(413)
+def too_large(e):
+
+    # The budget page posts with fetch and shows the response message
+    if request.is_json:
+        return jsonify({"response": "Budget is too large to be saved"}), 413
+
+    # Text to go on the image
+    top = escape_chars("that's too much")
+    bottom = escape_chars("but that's none of my business")
+
+    return render_template("400.html", code=413, message="Payload Too Large", top=top, bottom=bottom), 413
+
+
 # Server error responses
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(e):
+
+    # Too many passwords are being hashed, ask the client to come back shortly
+    top = escape_chars("too many logins at once")
+    bottom = escape_chars("try again in a moment")
+
+    response = make_response(render_template("400.html", code=503, message="Service Unavailable", top=top, bottom=bottom), 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
 @app.errorhandler(500)
 def server_error(e):
 
@@ -549,4 +1380,14 @@ def server_error(e):
     top = " "
     bottom = escape_chars("this is fine")
 
-    return render_template("500.html", code=500, message="Internal Server Error", top=top, bottom=bottom)
\ No newline at end of file
+    return render_template("500.html", code=500, message="Internal Server Error", top=top, bottom=bottom)
+
+
+# Replace the sync budget routes now that they're all registered
+if ASYNC_MODE:
+    from async_views import init_async
+    init_async(
+        app,
+        os.getenv("ASYNC_DATABASE_URL", os.getenv("DATABASE_URL")),
+        os.getenv("ASYNC_DATABASE_REPLICA_URL", os.getenv("DATABASE_REPLICA_URL"))
+        )
\ No newline at end of file
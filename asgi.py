@@ -0,0 +1,6 @@
+from asgiref.wsgi import WsgiToAsgi
+from app import app
+
+
+# ASGI entry point for servers like uvicorn or hypercorn: uvicorn asgi:application
+application = WsgiToAsgi(app)
@@ -0,0 +1,333 @@
+import asyncio
+import contextvars
+import threading
+
+from concurrent.futures import Future
+from functools import partial, wraps
+from flask import g, render_template, request, session, redirect, flash, url_for, jsonify, abort, make_response
+from markupsafe import Markup
+from sqlalchemy import make_url
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from db_models import *
+from helpers import login_required, encrypt_batch, encrypt_packed
+from replicas import read_only, mark_write, remember_writes
+from account_deletion import budget_tokens
+from app import KEY, CRYPTO_MODE, DECRYPT_CACHE, FRAGMENT_CACHE, BUDGET_STORAGE, BUDGET_VALIDATOR, CATEGORIES, MAX_LEN, \
+    budget_page_query, split_page, budget_version_query, version_info, not_modified, cache_headers, \
+    budget_json, plan_summaries, update_budget
+
+
+# Sessions for the async engine and the async replica engine (if there is one), bound in init_async
+async_session = async_sessionmaker(expire_on_commit=False)
+replica_session = async_sessionmaker(expire_on_commit=False)
+
+# Async drivers for the database URLs the app is used with
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg"
+}
+
+
+def async_url(url):
+
+    # Use the async driver for the same database, e.g. sqlite:///budget.db -> sqlite+aiosqlite:///budget.db
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+class EventLoopThread:
+
+    # Runs the async views on one long lived event loop in a background thread. Flask's default
+    # starts a new loop for every request, then the async engine couldn't keep pooled connections
+    # (they belong to the loop they were opened on), and requests couldn't share the loop while
+    # they wait on the database
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async-views", daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+
+        # Run the coroutine with the caller's context, so request, session etc. are the ones of the request
+        context = contextvars.copy_context()
+        future = Future()
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            self.loop.create_task(coroutine, context=context).add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(start)
+        return future.result()
+
+    def async_to_sync(self, func):
+
+        # Used by Flask to call async views from the (sync) worker thread
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func(*args, **kwargs))
+
+        return wrapper
+
+
+async def run_crypto(func, *args, **kwargs):
+
+    # Encryption and decryption are CPU bound, run them in the default executor so the
+    # loop can keep serving other requests in the meantime. The request context goes along for the timings
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, partial(func, *args, **kwargs))
+
+
+def read_session():
+
+    # Session for the reads of a read only route, on the replica unless the user wrote something recently
+    if g.get("use_replica") and replica_session.kw.get("bind") is not None:
+        return replica_session()
+    return async_session()
+
+
+async def index():
+
+    async def render():
+
+        # Select the first page of the users budgets, the rest are loaded from /api/budgets
+        async with read_session() as db_session:
+            budgets = (await db_session.execute(budget_page_query(session["user_id"]))).all()
+        budgets, next_cursor = split_page(budgets)
+        return render_template("fragments/index.html", budgets=budgets, next_cursor=next_cursor)
+
+    # The list only changes when the user writes something, which invalidates their fragments
+    fragment = await FRAGMENT_CACHE.get_or_render_async(FRAGMENT_CACHE.key(session["user_id"], "index"), render)
+
+    return render_template("index.html", fragment=Markup(fragment))
+
+
+async def budget(id):
+
+    error = None
+
+    # Check whether the client already has the current version before loading anything else
+    async with read_session() as db_session:
+        version = version_info(id, (await db_session.execute(budget_version_query(id))).one_or_none())
+    if version is None:
+        return abort(404)
+    user_id, etag, last_modified = version
+
+    # Prevent other users from accessing current users budgets
+    if session["user_id"] != user_id:
+        return abort(401)
+
+    # Pending flash messages have to be rendered, so the page can't come from the browser cache then
+    if not session.get("_flashes") and not_modified(etag, last_modified):
+        return cache_headers(make_response("", 304), etag, last_modified)
+
+    async def render():
+
+        # Expenses are loaded up front, there's no lazy loading with the async session
+        async with read_session() as db_session:
+            budget = (await db_session.execute(
+                db.select(Budget).options(*load_encrypted(Budget.expenses)).where(Budget.id == id)
+                )).scalar_one()
+
+        # Decrypt the budget into the same structure that's used when creating a budget
+        json = await run_crypto(budget_json, budget)
+        return render_template("fragments/budget.html", json=json, categories=CATEGORIES, max_len=MAX_LEN)
+
+    # The etag includes the version, so the fragment is only rendered again after the budget is updated.
+    # Last modified tells it apart from an earlier budget that had the same id and version
+    try:
+        fragment = await FRAGMENT_CACHE.get_or_render_async(
+            FRAGMENT_CACHE.key(user_id, "budget", etag), render
+            )
+    except (TypeError, ValueError):
+        error = "Budget could not be loaded, unable to convert values"
+        flash(error)
+        return redirect(url_for("index"))
+
+    response = make_response(render_template("budget.html", fragment=Markup(fragment)))
+    return cache_headers(response, etag, last_modified)
+
+
+async def create():
+
+    if request.method == "POST":
+
+        # Get the JSON object containing form data, bodies over MAX_CONTENT_LENGTH are rejected before parsing
+        form = request.json
+
+        # If something is wrong with the form, return the error message to display
+        error = BUDGET_VALIDATOR.error(form)
+        if error is not None:
+            return jsonify({"response": error})
+
+        # Break it up into budget and expense data
+        budget = form.get("info")
+        expenses = form.get("categories")
+
+        # Same storage modes as the sync create
+        packed = BUDGET_STORAGE == "packed"
+        rows = [] if packed else [
+            (category, expense, expenses[category][expense])
+            for category in expenses.keys() for expense in expenses[category]
+            ]
+
+        # Encrypt the budget values, all of the expense amounts and the category totals
+        encrypted = await run_crypto(
+            encrypt_batch, [budget.get("total"), budget.get("result")] + [amount for _, _, amount in rows], KEY,
+            CRYPTO_MODE, cache=DECRYPT_CACHE
+            )
+        packed_token = await run_crypto(encrypt_packed, expenses, KEY, DECRYPT_CACHE) if packed else None
+
+        async with async_session() as db_session:
+            try:
+                # Same bulk write path as insert_budget, the id comes back from the INSERT
+                budget_id = (await db_session.execute(
+                    db.insert(Budget)
+                    .values(user_id=session["user_id"], budget=encrypted[0], result=encrypted[1],
+                            name=budget.get("name"), packed=packed_token)
+                    .returning(Budget.id)
+                    )).scalar_one()
+
+                if rows:
+                    await db_session.execute(
+                        db.insert(Expense),
+                        [
+                            {"budget_id": budget_id, "category": category, "note": expense, "amount": amount}
+                            for (category, expense, _), amount in zip(rows, encrypted[2:])
+                        ]
+                        )
+
+                summaries, _, _ = await run_crypto(plan_summaries, budget_id, expenses)
+                if summaries:
+                    await db_session.execute(db.insert(BudgetSummary), [
+                        {"budget_id": budget_id, "category": row.category, "total": row.total, "count": row.count}
+                        for row in summaries
+                        ])
+                await db_session.commit()
+                mark_write()
+
+            except IntegrityError:
+                await db_session.rollback()
+                error = "Budget could not be saved"
+                return jsonify({"response": error})
+
+        FRAGMENT_CACHE.invalidate_user(session["user_id"])
+        return jsonify({"url": url_for("index")})
+
+    else:
+        return render_template("create.html", categories=CATEGORIES, max_len=MAX_LEN)
+
+
+async def update():
+
+    # Get the form data that was submitted, bodies over MAX_CONTENT_LENGTH are rejected before parsing
+    form = request.json
+
+    # Check for errors in the form
+    error = BUDGET_VALIDATOR.error(form)
+    if error is not None:
+        return jsonify({"response": error})
+
+    # Break it up into budget and expense data
+    budget = form.get("info")
+    expenses = form.get("categories")
+
+    async with async_session() as db_session:
+
+        # Select budget by id and user_id, with the rows update_budget needs
+        try:
+            cur_budget = (await db_session.execute(
+                db.select(Budget)
+                .options(*load_encrypted(Budget.expenses, Budget.summaries))
+                .where((Budget.id == budget.get("id")) & (Budget.user_id == session["user_id"]))
+                )).scalar_one()
+        except NoResultFound:
+            error = "Budget could not be found"
+            return jsonify({"response": error})
+
+        # Decrypting, comparing and re-encrypting happens off the loop
+        try:
+            adds, deletes, stale, revisions = await run_crypto(update_budget, cur_budget, budget, expenses, form.get("ids"))
+        except (TypeError, ValueError):
+            await db_session.rollback()
+            error = "One or more values could not be processed as float"
+            return jsonify({"response": error})
+
+        db_session.add_all(adds)
+        for row in deletes:
+            await db_session.delete(row)
+        await db_session.execute(db.insert(BudgetRevision), revisions)
+
+        try:
+            await db_session.commit()
+            mark_write()
+        except IntegrityError:
+            await db_session.rollback()
+            error = "Data could not be saved"
+            return jsonify({"response": error})
+
+    DECRYPT_CACHE.invalidate(stale)
+    FRAGMENT_CACHE.invalidate_user(session["user_id"])
+    return jsonify({"url": url_for("budget", id=cur_budget.id)})
+
+
+async def delete():
+
+    # Select the form input with name id
+    id = request.form.get("id")
+
+    # Delete the budget in a single statement, making sure user_id matches. Its expenses and
+    # summaries are deleted by the database (ON DELETE CASCADE), so the ciphertexts of all three
+    # are read first to remove them from the decrypt cache
+    owned = (Budget.id == id) & (Budget.user_id == session["user_id"])
+    async with async_session() as db_session:
+        connection = await db_session.connection()
+        tokens = await connection.run_sync(budget_tokens, owned)
+        deleted = (await db_session.execute(db.delete(Budget).where(owned).returning(Budget.id))).one_or_none()
+        if deleted is None:
+            flash("Budget was not found")
+            return redirect("/")
+        await db_session.commit()
+        mark_write()
+
+    DECRYPT_CACHE.invalidate(tokens)
+    FRAGMENT_CACHE.invalidate_user(session["user_id"])
+
+    # Redirect to show the new list of budgets
+    return redirect("/")
+
+
+def init_async(app, url, replica_url=None):
+
+    # Swap the sync budget routes for the async ones, which use an AsyncSession on a shared event loop
+    engine = create_async_engine(async_url(url))
+    async_session.configure(bind=engine)
+    if "instrumentation" in app.extensions:
+        app.extensions["instrumentation"].attach_engine(engine.sync_engine)
+
+    # The index and budget pages read from the replica, like the sync routes
+    if replica_url:
+        replica_engine = create_async_engine(async_url(replica_url))
+        replica_session.configure(bind=replica_engine)
+        if "instrumentation" in app.extensions:
+            app.extensions["instrumentation"].attach_engine(replica_engine.sync_engine)
+        remember_writes(app)
+
+    runner = EventLoopThread()
+    app.async_to_sync = runner.async_to_sync
+
+    for view in [index, budget]:
+        app.view_functions[view.__name__] = login_required(read_only(app.ensure_sync(view)))
+    for view in [create, update, delete]:
+        app.view_functions[view.__name__] = login_required(app.ensure_sync(view))
+
+    app.extensions["async_engine"] = engine
@@ -0,0 +1,94 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# Every request should reach the database and decrypt, so the caches are off
+os.environ.setdefault("FRAGMENT_CACHE", "null")
+os.environ.setdefault("DECRYPT_CACHE_BYTES", "0")
+
+import common
+
+
+# Concurrent clients, each sends requests back to back for DURATION seconds
+CLIENTS = [1, 8, 32]
+DURATION = 5
+
+# Budgets the clients pick from, and the expenses in each
+BUDGETS = 50
+EXPENSES = 50
+
+
+def child():
+
+    # Runs in its own process, since the mode is picked when the app is imported
+    from app import app, insert_budget, write_summaries, KEY, CRYPTO_MODE
+    from db_models import db, User
+    from helpers import encrypt_batch
+
+    with app.app_context():
+        db.create_all()
+        user_id = common.create_user(db, User)
+
+        expenses = {"food": {f"expense{i}": i + 0.5 for i in range(EXPENSES)}}
+        rows = [("food", expense, amount) for expense, amount in expenses["food"].items()]
+        ids = []
+        for i in range(BUDGETS):
+            encrypted = encrypt_batch([1000, 100] + [amount for _, _, amount in rows], KEY, CRYPTO_MODE)
+            ids.append(insert_budget(user_id, f"budget{i}", encrypted[0], encrypted[1], None, list(zip(rows, encrypted[2:]))))
+            write_summaries(ids[-1], expenses)
+        db.session.commit()
+
+    results = {}
+    for clients in CLIENTS:
+        counts = [0] * clients
+        stop = time.perf_counter() + DURATION
+
+        def worker(n):
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+            pick = random.Random(n)
+            while time.perf_counter() < stop:
+                path = "/" if pick.random() < 0.2 else f"/budget/{pick.choice(ids)}"
+                client.get(path).close()
+                counts[n] += 1
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[clients] = sum(counts) / DURATION
+
+    print(json.dumps(results))
+
+
+def main():
+
+    print(f"Requests/sec, 80% budget pages and 20% index pages, {EXPENSES} expenses per budget")
+    print(f"{'clients':>8}{'sync':>10}{'async':>10}")
+
+    results = {}
+    for mode in ["sync", "async"]:
+
+        # A fresh database for each mode
+        env = dict(os.environ, ASYNC_MODE="1" if mode == "async" else "0")
+        env["DATABASE_URL"] = os.environ["DATABASE_URL"].replace("bench.db", f"bench_{mode}.db")
+        output = subprocess.run(
+            [sys.executable, __file__, "--child"], env=env, capture_output=True, text=True, check=True
+            ).stdout
+        results[mode] = json.loads(output.splitlines()[-1])
+
+    for clients in CLIENTS:
+        print(f"{clients:>8}{results['sync'][str(clients)]:>10.1f}{results['async'][str(clients)]:>10.1f}")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child()
+    else:
+        main()
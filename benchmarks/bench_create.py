@@ -0,0 +1,65 @@
+import time
+
+import common
+from app import app, insert_budget, KEY, CRYPTO_MODE
+from db_models import *
+from helpers import encrypt_batch
+
+
+# Number of expenses in each budget
+COUNTS = [10, 100, 1000]
+
+# Budgets created per run, the fastest run is kept
+BUDGETS = 20
+REPEAT = 3
+
+
+def orm_loop(user_id, encrypted, rows):
+
+    # The old write path, flush the budget to get its id then add each expense as an ORM object
+    new_budget = Budget(user_id=user_id, budget=encrypted[0], result=encrypted[1], name="orm")
+    db.session.add(new_budget)
+    db.session.flush()
+    for (category, expense, _), amount in zip(rows, encrypted[2:]):
+        db.session.add(Expense(budget_id=new_budget.id, category=category, note=expense, amount=amount))
+    db.session.commit()
+
+
+def bulk(user_id, encrypted, rows):
+    insert_budget(user_id, "bulk", encrypted[0], encrypted[1], None, list(zip(rows, encrypted[2:])))
+    db.session.commit()
+
+
+def measure(func, user_id, encrypted, rows):
+
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(BUDGETS):
+            func(user_id, encrypted, rows)
+        elapsed = (time.perf_counter() - start) / BUDGETS
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+
+    db.create_all()
+    user_id = common.create_user(db, User)
+
+    print(f"{'expenses':>10}{'orm loop (ms)':>16}{'bulk (ms)':>12}{'speedup':>10}")
+    for count in COUNTS:
+        rows = [("food", f"expense{i}", i + 0.5) for i in range(count)]
+
+        # Encryption is the same for both paths, so it's done once up front
+        encrypted = encrypt_batch([100, 50] + [amount for _, _, amount in rows], KEY, CRYPTO_MODE)
+
+        orm = measure(orm_loop, user_id, encrypted, rows)
+        fast = measure(bulk, user_id, encrypted, rows)
+        print(f"{count:>10}{orm * 1000:>16.2f}{fast * 1000:>12.2f}{orm / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
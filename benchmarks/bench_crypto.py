@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+
+from cryptography.fernet import Fernet
+
+# Allow importing helpers when running the script from the benchmarks folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from helpers import encrypt_batch, decrypt_batch
+
+
+# Number of expenses to decrypt in each run
+COUNTS = [10, 100, 500, 1000, 5000]
+MODES = ["serial", "thread", "process"]
+
+# Repeat each run and keep the fastest, to smooth out noise
+REPEAT = 5
+
+
+def measure(tokens, key, mode):
+
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        decrypt_batch(tokens, key, mode, threshold=0)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+
+    key = Fernet(Fernet.generate_key())
+
+    # Warm up the pools so their start-up cost isn't counted
+    for mode in MODES:
+        decrypt_batch(encrypt_batch([1.0] * 64, key, "serial"), key, mode, threshold=0)
+
+    print(f"{'expenses':>10}" + "".join(f"{mode + ' (tokens/s)':>22}" for mode in MODES))
+    for count in COUNTS:
+        tokens = encrypt_batch([i * 1.25 for i in range(count)], key, "serial")
+        row = f"{count:>10}"
+        for mode in MODES:
+            row += f"{count / measure(tokens, key, mode):>22,.0f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import random
+import statistics
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+import app as budget_app
+from db_models import *
+from passwords import PasswordHasher
+
+
+# Threads serving requests, like a threaded server with this many workers
+REQUEST_THREADS = 8
+
+# A burst of logins mixed in with regular page views, all arriving at once
+LOGINS = 40
+VIEWS = 400
+
+PASSWORD = "Benchmark1!"
+
+# Hashing on the request threads vs on a bounded pool
+SETUPS = {
+    "inline": dict(mode="inline"),
+    "process, queue 2": dict(mode="process", workers=2, max_queue=2),
+    "process, queue 8": dict(mode="process", workers=2, max_queue=8)
+}
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+
+def run(app, user_id):
+
+    local = threading.local()
+
+    def view():
+
+        # Each request thread keeps its own logged in client
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+            with local.client.session_transaction() as session:
+                session["user_id"] = user_id
+        return local.client.get("/api/budgets").status_code
+
+    def login():
+        client = app.test_client()
+        return client.post("/login", data={"username": "bench", "password": PASSWORD}).status_code
+
+    requests = [login] * LOGINS + [view] * VIEWS
+    random.Random(0).shuffle(requests)
+
+    # Latency is measured from when the request arrives, so time spent waiting for a thread counts
+    def timed(func, arrived):
+        status = func()
+        return func, status, time.perf_counter() - arrived
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=REQUEST_THREADS) as executor:
+        futures = [executor.submit(timed, func, time.perf_counter()) for func in requests]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    views = [seconds for func, _, seconds in results if func is view]
+    logins = [status for func, status, _ in results if func is login]
+    return elapsed, views, logins
+
+
+def main():
+
+    db.create_all()
+
+    # The user logs in with a real hash, made with the configured method
+    user = User(
+        username="bench", username_lower="bench", email="bench@example.com",
+        password=PasswordHasher(budget_app.HASHER.method, mode="inline").hash(PASSWORD)
+        )
+    db.session.add(user)
+    db.session.commit()
+
+    print(f"{REQUEST_THREADS} request threads, {LOGINS} logins and {VIEWS} page views, method {budget_app.HASHER.method}")
+    print(f"{'setup':<20}{'total (s)':>10}{'view p50':>10}{'view p95':>10}{'view p99':>10}{'logins ok':>11}{'503':>6}")
+    for name, options in SETUPS.items():
+        budget_app.HASHER = PasswordHasher(budget_app.HASHER.method, **options)
+        elapsed, views, logins = run(budget_app.app, user.id)
+
+        p50, p95, p99 = (percentile(views, p) * 1000 for p in (50, 95, 99))
+        ok = sum(status == 302 for status in logins)
+        busy = sum(status == 503 for status in logins)
+        print(f"{name:<20}{elapsed:>10.2f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{ok:>11}{busy:>6}")
+    print("view latencies in ms")
+
+
+if __name__ == "__main__":
+    with budget_app.app.app_context():
+        main()
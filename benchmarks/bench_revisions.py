@@ -0,0 +1,111 @@
+import time
+import random
+
+import common
+import app as budget_app
+from db_models import *
+from revisions import budget_state, serialize, encrypt_revision
+
+
+# Number of expenses in each budget, and how often it's updated
+COUNTS = [50, 500]
+UPDATES = 100
+
+# Checkpoint intervals compared, 1 stores every revision in full
+INTERVALS = [1, 5, 10, 20]
+
+CATEGORIES = budget_app.CATEGORIES
+
+
+def new_budget(expenses):
+    categories = {}
+    for i in range(expenses):
+        categories.setdefault(CATEGORIES[i % len(CATEGORIES)], {})[f"expense {i}"] = 10.0 + i
+    return {"info": {"name": "Benchmark", "total": 100000, "result": 0, "id": None}, "categories": categories}
+
+
+def edit(form, rng, step):
+
+    # A typical edit changes the cost of a couple of expenses, every tenth one also replaces an expense
+    categories = form["categories"]
+    for _ in range(2):
+        category = rng.choice(list(categories))
+        expense = rng.choice(list(categories[category]))
+        categories[category][expense] = round(categories[category][expense] + rng.uniform(1, 50), 2)
+    if step % 10 == 0:
+        category = rng.choice(list(categories))
+        if len(categories[category]) > 1:
+            del categories[category][next(iter(categories[category]))]
+        categories[category][f"added {step}"] = 5.0
+    form["info"]["result"] = round(sum(sum(expenses.values()) for expenses in categories.values()), 2)
+
+
+def run(client, expenses, interval):
+
+    budget_app.REVISION_CHECKPOINT = interval
+    rng = random.Random(0)
+
+    form = new_budget(expenses)
+    client.post("/create", json=form)
+    form["info"]["id"] = db.session.execute(db.select(db.func.max(Budget.id))).scalar()
+
+    # What storing every revision as a full (compressed, encrypted) copy would take, for comparison
+    def full_copy():
+        return len(encrypt_revision(serialize(budget_state(form["info"], form["categories"])), budget_app.KEY))
+
+    full_bytes = full_copy()
+    update_seconds = 0
+    for step in range(1, UPDATES + 1):
+        edit(form, rng, step)
+        start = time.perf_counter()
+        client.post("/update", json=form)
+        update_seconds += time.perf_counter() - start
+        full_bytes += full_copy()
+    update_ms = update_seconds / UPDATES * 1000
+
+    budget_id = form["info"]["id"]
+    log_bytes, revisions, deltas = db.session.execute(
+        db.select(
+            db.func.sum(db.func.length(BudgetRevision.data)), db.func.count(),
+            db.func.max(BudgetRevision.revision - BudgetRevision.checkpoint)
+            )
+        .where(BudgetRevision.budget_id == budget_id)
+        ).one()
+
+    # Rebuild every revision the way /api/budget/<id>/revisions/<revision> does (one query, decrypt, apply)
+    times = []
+    for revision in range(1, revisions + 1):
+        start = time.perf_counter()
+        budget_app.load_revision(budget_id, revision)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "log_bytes": log_bytes, "full_bytes": full_bytes, "deltas": deltas, "update_ms": update_ms,
+        "rebuild_mean_ms": sum(times) / len(times), "rebuild_max_ms": max(times)
+    }
+
+
+def main():
+
+    db.create_all()
+    user_id = common.create_user(db, User)
+    client = budget_app.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+    print(f"{UPDATES} updates per budget, sizes in bytes, times in ms")
+    print(f"{'expenses':>8} {'interval':>8} {'log':>10} {'full copies':>12} {'ratio':>6} {'max deltas':>10} "
+          f"{'update':>8} {'rebuild':>8} {'max':>8}")
+    for expenses in COUNTS:
+        for interval in INTERVALS:
+            result = run(client, expenses, interval)
+            print(
+                f"{expenses:>8} {interval:>8} {result['log_bytes']:>10} {result['full_bytes']:>12} "
+                f"{result['log_bytes'] / result['full_bytes']:>6.2f} {result['deltas']:>10} {result['update_ms']:>8.2f} "
+                f"{result['rebuild_mean_ms']:>8.2f} {result['rebuild_max_ms']:>8.2f}"
+                )
+
+
+if __name__ == "__main__":
+    with budget_app.app.app_context():
+        main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+import common
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Each one runs in a fresh interpreter, like a newly forked worker or a test process. The time is from
+# starting the interpreter to the end of the snippet, so the interpreter's own startup is included
+STARTUPS = {
+    "python": "pass",
+    "create_app()": "from factory import create_app; create_app()",
+    "import app": "import app",
+    "first request": "import app; app.app.test_client().get('/login')"
+}
+
+# The modules of the app (and the ones they import) shown in the import time breakdown
+TOP_IMPORTS = 15
+
+
+def cold_start(code, runs):
+
+    # Median wall time of starting a new interpreter and running the code, in ms
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), min(times)
+
+
+def import_times(module):
+
+    # Cumulative import time per module imported directly by the app, from python -X importtime
+    # https://docs.python.org/3/using/cmdline.html#cmdoption-X
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT, check=True, capture_output=True, text=True
+        )
+    times = {}
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+
+        # Nesting is shown by indentation and a module is listed after everything it imported, so the
+        # modules one level in that come right before the module itself are the ones it imported
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == module:
+            times[module] = int(cumulative) / 1000
+            break
+        if depth == 0:
+            times = {}
+        elif depth == 1:
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Cold start time of the app, run it before and after changing imports")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"Cold start (ms, median and min of {args.runs} runs)")
+    for name, code in STARTUPS.items():
+        median, fastest = cold_start(code, args.runs)
+        print(f"  {name:<16} {median:8.1f} {fastest:8.1f}")
+
+    print("\nSlowest imports of app (ms, cumulative, single run)")
+    times = import_times("app")
+    for name, ms in sorted(times.items(), key=lambda item: item[1], reverse=True)[:TOP_IMPORTS]:
+        print(f"  {name:<28} {ms:8.1f}")
+
+    # Rarely used modules that shouldn't be imported at startup any more
+    deferred = ["validator_collection", "jsonschema", "async_views"]
+    loaded = subprocess.run(
+        [sys.executable, "-c", f"import sys, app; print(' '.join(m for m in {deferred!r} if m in sys.modules))"],
+        cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.split()
+    print(f"\nDeferred modules imported at startup: {', '.join(loaded) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
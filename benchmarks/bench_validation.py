@@ -0,0 +1,76 @@
+import json
+import time
+
+import common
+import app as budget_app
+from db_models import *
+
+
+REPEAT = 200
+
+CATEGORIES = budget_app.CATEGORIES
+
+
+def budget(expenses, name_length=20, category=None, amount=1.5):
+
+    # A budget with the expenses spread over the valid categories
+    categories = {}
+    for i in range(expenses):
+        categories.setdefault(category or CATEGORIES[i % len(CATEGORIES)], {})[f"{i:0{name_length}d}"] = amount
+    return {"info": {"name": "Benchmark", "total": 1000, "result": 1.5 * expenses, "id": None}, "categories": categories}
+
+
+def payloads():
+
+    last_bad = budget(499)
+    last_bad["categories"]["other"]["zero"] = 0
+
+    return {
+        "valid, 20 expenses": budget(20),
+        "valid, 500 expenses": budget(500, name_length=100),
+        "100k expenses": budget(100_000),
+        "invalid category": budget(500, category="not a category"),
+        "last amount is 0": last_bad,
+        "amounts are objects": budget(500, amount={"nested": [1] * 50})
+    }
+
+
+def per_call(func, repeat=REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+
+    validator = budget_app.BUDGET_VALIDATOR
+
+    # Cost of the validation alone, the payloads are already parsed
+    print("Validation (ms per payload)")
+    for name, payload in payloads().items():
+        ms, error = per_call(lambda: validator.error(payload), 20 if "100k" in name else REPEAT)
+        print(f"  {name:<22} {ms:8.3f}  {error}")
+
+    # Whole /create requests, the body has to be read and parsed before it's validated, unless it's over
+    # MAX_CONTENT_LENGTH in which case it's turned away with a 413 straight away
+    db.create_all()
+    user_id = common.create_user(db, User)
+    client = budget_app.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+    print(f"\n/create requests (ms per request), MAX_CONTENT_LENGTH {budget_app.app.config['MAX_CONTENT_LENGTH']} bytes")
+    for name, payload in payloads().items():
+        if name.startswith("valid"):
+            continue
+        body = json.dumps(payload)
+        ms, response = per_call(
+            lambda: client.post("/create", data=body, content_type="application/json"), 20 if "100k" in name else REPEAT
+            )
+        print(f"  {name:<22} {ms:8.3f}  {response.status_code} {response.json['response']} ({len(body)} bytes)")
+
+
+if __name__ == "__main__":
+    with budget_app.app.app_context():
+        main()
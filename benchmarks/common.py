@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+from cryptography.fernet import Fernet
+
+# Allow importing the app modules when running a script from the benchmarks folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Benchmarks run against a throwaway SQLite database unless DATABASE_URL is set,
+# and a throwaway key unless SECRET_KEY is set. These need to be set before app is imported
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("SECRET_KEY", Fernet.generate_key().decode())
+
+
+def create_user(db, User, name="bench"):
+
+    # Insert a user to own the benchmark budgets, the password is never checked
+    user = User(username=name, username_lower=name.lower(), password="-", email=f"{name.lower()}@example.com")
+    db.session.add(user)
+    db.session.commit()
+
+    return user.id
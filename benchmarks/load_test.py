@@ -0,0 +1,396 @@
+import argparse
+import io
+import gzip
+import uuid
+import http.cookiejar
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import common
+from seed import seed, make_budget, PASSWORD
+
+# Brotli is optional, without it only gzip is asked for
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Budgets in the file each new user imports
+IMPORT_BUDGETS = 5
+
+# The most queries each route may issue, the load test fails when a route goes over. These don't depend on
+# the number of budgets or expenses, so going over usually means a lazy load (N+1) crept back in. The budget
+# pages check the version, then load the budget and its expenses (selectinload), update also loads the
+# summaries and writes the budget, the changed expenses, the changed summaries and the revision, create inserts the
+# budget, its expenses and its summaries, delete reads the ciphertexts to drop from the decrypt cache and deletes.
+# The revision routes check the owner and read the revision chain, a restore then saves like an update. Import
+# saves each budget the way create does. The exports stream their queries after the headers have been sent,
+# so the Server-Timing header only counts what runs before the first row
+QUERY_BUDGETS = {
+    "login": 1,
+    "index": 1,
+    "api_budgets": 1,
+    "budget": 3,
+    "api_budget": 3,
+    "budget_summary": 2,
+    "account": 1,
+    "create_form": 0,
+    "update": 7,
+    "create": 3,
+    "delete": 2,
+    "export": 0,
+    "export_csv": 0,
+    "revisions": 2,
+    "revision": 2,
+    "restore": 8,
+    "register": 1,
+    "import": 3 * IMPORT_BUDGETS,
+    "change_password": 2,
+    "logout": 0,
+    "delete_account": 4
+}
+
+
+def decode(body, encoding):
+
+    # The drivers ask for compressed responses like a browser does, the size is measured before decoding
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "br":
+        return brotli.decompress(body)
+    return body
+
+
+def server_timing(header):
+
+    # Parse "db;dur=0.44;desc="3 queries", crypto;dur=3.14, ..." into durations and the query count
+    timings, queries = {}, None
+    for metric in (header or "").split(","):
+        name, _, params = metric.strip().partition(";")
+        duration = re.search(r"dur=([\d.]+)", params)
+        if duration:
+            timings[name] = float(duration.group(1))
+        count = re.search(r'desc="(\d+) queries"', params)
+        if count:
+            queries = int(count.group(1))
+
+    return timings, queries
+
+
+class TestClientDriver:
+
+    # Sends requests to the app in this process through the Flask test client
+
+    def __init__(self, accept_encoding=None):
+        from app import app
+
+        # The query counts and timings are read from the Server-Timing header
+        app.extensions["instrumentation"].server_timing = True
+        self.client = app.test_client()
+        self.accept_encoding = accept_encoding
+
+    def request(self, method, path, data=None, payload=None, headers=None, files=None):
+        headers = dict(headers or {})
+        if self.accept_encoding:
+            headers["Accept-Encoding"] = self.accept_encoding
+        if files:
+            data = {**(data or {}), **{name: (io.BytesIO(content), filename) for name, (filename, content) in files.items()}}
+
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, data=data, json=payload, headers=headers)
+        body = response.get_data()
+        seconds = time.perf_counter() - start
+        response.close()
+        return response.status_code, seconds, response.headers, len(body), decode(body, response.headers.get("Content-Encoding"))
+
+
+class HTTPDriver:
+
+    # Sends requests to a running server, it needs SERVER_TIMING=1 for the query counts and timings
+
+    def __init__(self, url, accept_encoding=None):
+        self.url = url.rstrip("/")
+        self.accept_encoding = accept_encoding
+
+        # Keep the session cookie, but don't follow redirects so every request is measured on its own
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect
+            )
+
+    def request(self, method, path, data=None, payload=None, headers=None, files=None):
+        headers = dict(headers or {})
+        if self.accept_encoding:
+            headers["Accept-Encoding"] = self.accept_encoding
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode()
+            headers["Content-Type"] = "application/json"
+        elif files:
+            body, headers["Content-Type"] = multipart(data or {}, files)
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(self.url + path, body, headers, method=method)) as response:
+                content = response.read()
+                status, response_headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            content = error.read()
+            status, response_headers = error.code, error.headers
+
+        seconds = time.perf_counter() - start
+        return status, seconds, response_headers, len(content), decode(content, response_headers.get("Content-Encoding"))
+
+
+def multipart(data, files):
+
+    # Encode form fields and files ({name: (filename, content)}) as multipart/form-data, like a file upload form
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in data.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b"\r\n"
+            )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def page_assets(html):
+
+    # The static files a page loads, its stylesheets and scripts and the modules in its import map
+    assets = re.findall(r'(?:src|href)="(/static/[^"]+)"', html)
+    import_map = re.search(r'<script type="importmap">(.*?)</script>', html, re.S)
+    if import_map:
+        assets += json.loads(import_map.group(1))["imports"].values()
+    return list(dict.fromkeys(assets))
+
+
+def load_page(driver, path, cache):
+
+    # Load a page and its static files one after the other, like a browser with an HTTP cache. Files with a
+    # max-age that haven't expired come from the cache, others are revalidated with If-None-Match.
+    # Returns (status, seconds, bytes transferred)
+    status, seconds, headers, size, body = driver.request("GET", path)
+    for asset in page_assets(body.decode()):
+        etag, expires = cache.get(asset, (None, 0))
+        if time.time() < expires:
+            continue
+
+        asset_status, asset_seconds, asset_headers, asset_size, _ = driver.request(
+            "GET", asset, headers={"If-None-Match": etag} if etag else None
+            )
+        seconds += asset_seconds
+        size += asset_size
+
+        max_age = re.search(r"max-age=(\d+)", asset_headers.get("Cache-Control") or "")
+        cache[asset] = (asset_headers.get("ETag") or etag, time.time() + int(max_age.group(1)) if max_age else 0)
+
+    return status, seconds, size
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+def summarize(samples):
+
+    # samples is a list of (status, seconds, Server-Timing header, bytes transferred)
+    seconds = [sample[1] for sample in samples]
+    parsed = [server_timing(sample[2]) for sample in samples]
+    queries = [count for _, count in parsed if count is not None]
+
+    summary = {
+        "requests": len(samples),
+        "statuses": {str(status): sum(sample[0] == status for sample in samples) for status in sorted({s[0] for s in samples})},
+        "p50_ms": percentile(seconds, 50) * 1000,
+        "p95_ms": percentile(seconds, 95) * 1000,
+        "p99_ms": percentile(seconds, 99) * 1000,
+        "mean_ms": statistics.mean(seconds) * 1000,
+        "throughput_rps": len(seconds) / sum(seconds),
+        "bytes_mean": statistics.mean(sample[3] for sample in samples),
+        "queries_mean": statistics.mean(queries) if queries else None,
+        "queries_max": max(queries) if queries else None
+    }
+
+    # Mean of each part of the Server-Timing breakdown
+    for name in ["db", "crypto", "render"]:
+        values = [timings[name] for timings, _ in parsed if name in timings]
+        summary[f"{name}_ms"] = statistics.mean(values) if values else None
+
+    return summary
+
+
+def run(driver, users, requests, expenses, rng):
+
+    # Log in as the first seeded user and drive every route requests times, returns the raw samples per route
+    user = users[0]
+    samples = {}
+
+    def record(route, method, path, **kwargs):
+        status, seconds, headers, size, body = driver.request(method, path, **kwargs)
+        samples.setdefault(route, []).append((status, seconds, headers.get("Server-Timing"), size))
+        return status, body
+
+    for _ in range(requests):
+        record("login", "POST", "/login", data={"username": user["username"], "password": PASSWORD})
+
+    # Loading the index page with its static files, a first visit with an empty cache and then repeat visits.
+    # The time is a stand in for time to interactive, it leaves out the browser parsing and running the scripts
+    cache = {}
+    for i in range(requests):
+        status, seconds, size = load_page(driver, "/", cache)
+        samples.setdefault("page_load_first" if i == 0 else "page_load_repeat", []).append((status, seconds, None, size))
+
+    for _ in range(requests):
+        budget_id = rng.choice(user["budget_ids"])
+        record("index", "GET", "/")
+        record("api_budgets", "GET", "/api/budgets")
+        record("budget", "GET", f"/budget/{budget_id}")
+        record("api_budget", "GET", f"/api/budget/{budget_id}")
+        record("budget_summary", "GET", f"/api/budget/{budget_id}/summary")
+        record("account", "GET", "/account")
+        record("create_form", "GET", "/create")
+
+    # Updates change one amount of a budget, the way the budget page sends it
+    updated = []
+    for _ in range(requests):
+        updated.append(rng.choice(user["budget_ids"]))
+        *_, body = driver.request("GET", f"/api/budget/{updated[-1]}")
+        form = json.loads(body)
+        category = next(iter(form["categories"]))
+        expense = next(iter(form["categories"][category]))
+        form["categories"][category][expense] = round(rng.uniform(1, 500), 2)
+        form["info"]["result"] = round(sum(sum(items.values()) for items in form["categories"].values()), 2)
+        record("update", "POST", "/update", payload=form)
+
+    # New budgets are created and then deleted again, so the seeded data stays the same
+    created = []
+    for _ in range(requests):
+        info, categories = make_budget(rng, expenses)
+        record("create", "POST", "/create", payload={"info": {**info, "id": None}, "categories": categories})
+        *_, body = driver.request("GET", "/api/budgets?limit=1")
+        created.append(json.loads(body)["budgets"][0]["id"])
+
+    for budget_id in created:
+        record("delete", "POST", "/delete", data={"id": budget_id})
+
+    # Exports stream every budget of the user
+    for _ in range(requests):
+        record("export", "GET", "/export")
+        record("export_csv", "GET", "/export?format=csv")
+
+    # The revision log of the budgets updated above, listing it, rebuilding a revision and restoring one
+    # (the restore is saved as a new revision, like any update)
+    for budget_id in rng.choices(updated, k=requests):
+        _, body = record("revisions", "GET", f"/api/budget/{budget_id}/revisions")
+        revision = rng.choice(json.loads(body)["revisions"])["revision"]
+        record("revision", "GET", f"/api/budget/{budget_id}/revisions/{revision}")
+        record("restore", "POST", f"/budget/{budget_id}/revisions/{revision}/restore")
+
+    # The account routes, each time with a new user that imports a few budgets and is deleted again at
+    # the end, so the seeded data stays the same. This comes last since it logs the seeded user out
+    new_password = PASSWORD + "2"
+    for _ in range(requests):
+        username = f"load{uuid.uuid4().hex[:12]}"
+        record("register", "POST", "/register", data={
+            "username": username, "email": f"{username}@example.com", "password": PASSWORD, "confirmation": PASSWORD
+            })
+        driver.request("POST", "/login", data={"username": username, "password": PASSWORD})
+
+        budgets = []
+        for _ in range(IMPORT_BUDGETS):
+            info, categories = make_budget(rng, expenses)
+            budgets.append(json.dumps({"info": {**info, "id": None}, "categories": categories}))
+        record("import", "POST", "/import", files={"file": ("budgets.ndjson", "\n".join(budgets).encode())})
+
+        record("change_password", "POST", "/change-password", data={"old": PASSWORD, "new": new_password, "confirm": new_password})
+        record("logout", "GET", "/logout")
+        driver.request("POST", "/login", data={"username": username, "password": new_password})
+        record("delete_account", "POST", "/delete-account", data={"password": new_password})
+
+    return samples
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Seed a database and measure every route, results are printed as JSON")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--budgets", type=int, default=20, help="budgets per user")
+    parser.add_argument("--expenses", type=int, default=50, help="expenses per budget")
+    parser.add_argument("--requests", type=int, default=50, help="requests per route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="drive a running server (started with SERVER_TIMING=1) instead of the test client")
+    parser.add_argument("--no-seed", action="store_true", help="use users already seeded with seed.py")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--no-compression", action="store_true", help="don't send Accept-Encoding, to compare the bytes sent")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    # Seed, or look up the users a previous seed.py run created
+    if args.no_seed:
+        from app import app
+        from db_models import db, User, Budget
+        with app.app_context():
+            user = db.session.execute(db.select(User).where(User.username_lower == "seed0")).scalar_one()
+            budget_ids = db.session.execute(db.select(Budget.id).where(Budget.user_id == user.id)).scalars().all()
+        users = [{"id": user.id, "username": user.username, "budget_ids": budget_ids}]
+    else:
+        users = seed(args.users, args.budgets, args.expenses, args.seed)
+
+    # Ask for compressed responses the way browsers do
+    accept_encoding = None if args.no_compression else ("gzip, br" if brotli else "gzip")
+    driver = HTTPDriver(args.url, accept_encoding) if args.url else TestClientDriver(accept_encoding)
+    samples = run(driver, users, args.requests, args.expenses, rng)
+
+    results = {
+        "config": {
+            "users": args.users,
+            "budgets": args.budgets,
+            "expenses": args.expenses,
+            "requests": args.requests,
+            "seed": args.seed,
+            "target": args.url or "test client",
+            "accept_encoding": accept_encoding,
+            "database": os.environ["DATABASE_URL"].split("@")[-1],
+            "python": sys.version.split()[0]
+        },
+        "routes": {route: summarize(route_samples) for route, route_samples in samples.items()}
+    }
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+    # Query counts are only known when the responses have a Server-Timing header
+    over = {
+        route: summary["queries_max"] for route, summary in results["routes"].items()
+        if summary["queries_max"] is not None and summary["queries_max"] > QUERY_BUDGETS.get(route, summary["queries_max"])
+    }
+    for route, queries in over.items():
+        print(f"{route} issued {queries} queries, the most it may issue is {QUERY_BUDGETS[route]}", file=sys.stderr)
+    if over:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
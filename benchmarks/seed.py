@@ -0,0 +1,94 @@
+import argparse
+import random
+import time
+
+import common
+
+
+# Every seeded user has this password, so load tests can log in
+PASSWORD = "Benchmark1!"
+
+CATEGORIES = [
+    "housing", "transportation", "utilities", "food", "clothing", "medical", "insurance",
+    "personal", "debt", "savings", "retirement", "entertainment", "other"
+    ]
+
+
+def make_budget(rng, expenses):
+
+    # A budget in the same structure the create form sends, with expenses spread over a few categories
+    categories = {}
+    for i in range(expenses):
+        category = rng.choice(CATEGORIES[:6])
+        categories.setdefault(category, {})[f"expense{i}"] = round(rng.uniform(1, 500), 2)
+
+    result = round(sum(amount for expense in categories.values() for amount in expense.values()), 2)
+    return {"name": f"budget {rng.randrange(10000)}", "total": round(result * 1.2, 2), "result": result}, categories
+
+
+def seed(users, budgets, expenses, seed=0, prefix="seed"):
+
+    # Insert users x budgets x expenses through the app's own write path (encryption, bulk insert,
+    # summaries). The same arguments always produce the same data. Returns a list of
+    # {"id", "username", "budget_ids"}, one per user
+    from app import app, insert_budget, write_summaries, HASHER, KEY, CRYPTO_MODE
+    from db_models import db, User
+    from helpers import encrypt_batch
+    from passwords import PasswordHasher
+
+    rng = random.Random(seed)
+    seeded = []
+
+    with app.app_context():
+        db.create_all()
+
+        # Hashing is slow on purpose, every user gets the same (salted) hash
+        password = PasswordHasher(HASHER.method, mode="inline").hash(PASSWORD)
+
+        for n in range(users):
+            username = f"{prefix}{n}"
+            user = User(username=username, username_lower=username, password=password, email=f"{username}@example.com")
+            db.session.add(user)
+            db.session.flush()
+
+            budget_ids = []
+            for _ in range(budgets):
+                info, categories = make_budget(rng, expenses)
+                rows = [
+                    (category, expense, amount)
+                    for category, items in categories.items() for expense, amount in items.items()
+                    ]
+                encrypted = encrypt_batch(
+                    [info["total"], info["result"]] + [amount for _, _, amount in rows], KEY, CRYPTO_MODE
+                    )
+                budget_id = insert_budget(user.id, info["name"], encrypted[0], encrypted[1], None, list(zip(rows, encrypted[2:])))
+                write_summaries(budget_id, categories)
+                budget_ids.append(budget_id)
+
+            # One transaction per user keeps them reasonably sized
+            db.session.commit()
+            seeded.append({"id": user.id, "username": username, "budget_ids": budget_ids})
+
+    return seeded
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fill the database (DATABASE_URL) with synthetic users, budgets and expenses")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--budgets", type=int, default=20, help="budgets per user")
+    parser.add_argument("--expenses", type=int, default=50, help="expenses per budget")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed gives the same data")
+    parser.add_argument("--prefix", default="seed", help="usernames are prefix0, prefix1, ...")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    seeded = seed(args.users, args.budgets, args.expenses, args.seed, args.prefix)
+    print(
+        f"Seeded {len(seeded)} users, {args.budgets} budgets each with {args.expenses} expenses "
+        f"in {time.perf_counter() - start:.1f}s, password {PASSWORD}"
+        )
+
+
+if __name__ == "__main__":
+    main()
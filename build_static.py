@@ -0,0 +1,64 @@
+import os
+import gzip
+import argparse
+
+# Brotli is optional, without it only the gzip variants are made
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Text files compress well, images and fonts are already compressed
+EXTENSIONS = (".js", ".css", ".svg", ".html", ".json", ".txt")
+
+
+def variants(data):
+
+    # mtime=0 so the same file always gives the same .gz
+    yield ".gz", gzip.compress(data, 9, mtime=0)
+    if brotli is not None:
+        yield ".br", brotli.compress(data, quality=11)
+
+
+def build(folder):
+
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if not name.endswith(EXTENSIONS):
+                continue
+
+            path = os.path.join(root, name)
+            with open(path, "rb") as file:
+                data = file.read()
+
+            sizes = []
+            for suffix, compressed in variants(data):
+
+                # A variant that isn't smaller is removed, the file is served as is then
+                if len(compressed) >= len(data):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                    continue
+                with open(path + suffix, "wb") as file:
+                    file.write(compressed)
+                sizes.append(f"{suffix} {len(compressed)}")
+
+            print(f"{os.path.relpath(path, folder)}: {len(data)} bytes -> {', '.join(sizes) or 'not compressed'}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Write precompressed .gz (and .br with brotli installed) copies of the static files")
+    parser.add_argument("--folder", default=STATIC)
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("brotli isn't installed, only making .gz files (pip install brotli)")
+    build(args.folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,211 @@
-import os
+import argparse
 
-from flask import Flask
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
 from db_models import *
+from factory import create_app
 
-# Create app
-app = Flask(__name__)
+# Create app, configured the same way as app.py (DATABASE_URL and the pool settings)
+app = create_app()
+
+
+def explain_queries():
+
+    # The queries on the hot paths, listing a users budgets and loading the expenses of a budget
+    return {
+        "index": db.select(Budget.id, Budget.name, Budget.timestamp)
+                 .where(Budget.user_id == 1)
+                 .order_by(Budget.timestamp.desc()),
+        "expenses": db.select(Expense).where(Expense.budget_id == 1).order_by(Expense.category)
+    }
+
+
+def print_plans(label):
+
+    dialect = db.engine.dialect
+    prefix = "EXPLAIN QUERY PLAN" if dialect.name == "sqlite" else "EXPLAIN"
+
+    print(f"--- {label} ---")
+    with db.engine.connect() as connection:
+        for name, query in explain_queries().items():
+            sql = query.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+            print(f"{name}:")
+            for row in connection.execute(text(f"{prefix} {sql}")):
+                print("    " + " ".join(str(value) for value in row))
+
+
+def migrate():
+
+    # Create any tables that don't exist yet
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+
+            # Add columns that were declared after the table was created, only nullable ones
+            # or ones with a server default can be added to a table that already has rows
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    print(f"Skipped {table.name}.{column.name}, not nullable and has no default")
+                    continue
+
+                # Same column definition (type, default, NOT NULL) as CREATE TABLE would use
+                compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+                definition = compiler.get_column_specification(column)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+                print(f"Added column {table.name}.{column.name}")
+
+            # Add missing indexes
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    print(f"Added index {index.name}")
+
+
+def outdated_foreign_keys(inspector, table):
+
+    # Foreign keys whose ON DELETE differs from the model, as (model constraint, reflected constraint)
+    reflected = {tuple(fk["constrained_columns"]): fk for fk in inspector.get_foreign_keys(table.name)}
+    outdated = []
+    for constraint in table.foreign_key_constraints:
+        fk = reflected.get(tuple(constraint.column_keys))
+        ondelete = (fk or {}).get("options", {}).get("ondelete") or "NO ACTION"
+        if fk is not None and ondelete.upper() != (constraint.ondelete or "NO ACTION").upper():
+            outdated.append((constraint, fk))
+
+    return outdated
+
+
+def rebuild_foreign_keys_postgresql(table, outdated):
+
+    # Swap each constraint for one with the new ON DELETE. NOT VALID skips checking the existing rows
+    # while the table is locked, they're validated afterwards in a separate transaction that doesn't
+    # block writes
+    for constraint, fk in outdated:
+        name = fk["name"]
+        columns = ", ".join(constraint.column_keys)
+        referred = ", ".join(element.column.name for element in constraint.elements)
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+            connection.execute(text(
+                f"ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({columns}) "
+                f"REFERENCES {constraint.referred_table.name} ({referred}) ON DELETE {constraint.ondelete} NOT VALID"
+                ))
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} VALIDATE CONSTRAINT {name}"))
+
+
+def rebuild_table_sqlite(table, columns):
+
+    # SQLite can't alter a constraint, so the table is rebuilt with the current definition
+    # https://www.sqlite.org/lang_altertable.html#otheralter
+    metadata = MetaData()
+    for other in db.metadata.sorted_tables:
+        other.to_metadata(metadata)
+    new = table.to_metadata(metadata, name=f"_new_{table.name}")
+    columns = ", ".join(column.name for column in table.columns if column.name in columns)
+
+    with db.engine.connect() as connection:
+
+        # Foreign keys are turned off while the table is swapped, this can't be done inside a transaction
+        connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        connection.commit()
+
+        connection.execute(CreateTable(new))
+        connection.execute(text(f"INSERT INTO {new.name} ({columns}) SELECT {columns} FROM {table.name}"))
+        connection.execute(text(f"DROP TABLE {table.name}"))
+        connection.execute(text(f"ALTER TABLE {new.name} RENAME TO {table.name}"))
+
+        # Dropping the table dropped its indexes
+        for index in table.indexes:
+            index.create(connection)
+
+        violations = connection.exec_driver_sql(f"PRAGMA foreign_key_check({table.name})").all()
+        if violations:
+            connection.rollback()
+            raise SystemExit(f"{table.name} has {len(violations)} rows referencing missing rows, fix them and migrate again")
+        connection.commit()
+
+        connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+        connection.commit()
+
+
+def migrate_foreign_keys():
+
+    # Existing databases were created without ON DELETE CASCADE, rebuild the foreign keys that differ
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        outdated = outdated_foreign_keys(inspector, table)
+        if not outdated:
+            continue
+
+        if db.engine.dialect.name == "sqlite":
+            rebuild_table_sqlite(table, {column["name"] for column in inspector.get_columns(table.name)})
+        else:
+            rebuild_foreign_keys_postgresql(table, outdated)
+        print(f"Rebuilt foreign keys of {table.name} with ON DELETE CASCADE")
+
+
+def backfill_summaries(batch=100):
+
+    # Build the summary rows of budgets saved before the budget_summaries table existed, from their
+    # expenses, committing every batch budgets. Decrypting needs SECRET_KEY, so app.py is only imported
+    # when there's something to backfill. Returns the number of budgets backfilled
+    missing = db.session.execute(
+        db.select(Budget.id)
+        .where(~Budget.summaries.any() & (Budget.packed.is_not(None) | Budget.expenses.any()))
+        ).scalars().all()
+    if not missing:
+        return 0
+
+    from app import budget_json, write_summaries
+
+    for start in range(0, len(missing), batch):
+        budgets = db.session.execute(
+            db.select(Budget).options(*load_encrypted(Budget.expenses)).where(Budget.id.in_(missing[start:start + batch]))
+            ).scalars().all()
+        for budget in budgets:
+            try:
+                write_summaries(budget.id, budget_json(budget)["categories"])
+            except (TypeError, ValueError):
+                print(f"Skipped the summaries of budget {budget.id}, its values could not be converted")
+        db.session.commit()
+
+    return len(missing)
 
-# Configure db, get env variable with address
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db.init_app(app)
 
 def main():
 
+    parser = argparse.ArgumentParser(description="Create or migrate the database tables")
+    parser.add_argument(
+        "command", nargs="?", choices=["create", "migrate"], default="create",
+        help="create missing tables (default), or migrate existing tables to the current models"
+        )
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print_plans("Before")
+
+        # Safe to run more than once, only what's missing gets added
+        migrate()
+        migrate_foreign_keys()
+        print("Migrated tables")
+
+        backfilled = backfill_summaries()
+        if backfilled:
+            print(f"Built the summaries of {backfilled} budgets")
+
+        # Start from fresh connections so the plans see the new schema
+        db.engine.dispose()
+
+        print_plans("After")
+        return
+
     # Doesn't update tables if they're already in db
     db.create_all()
     print("Created tables")
@@ -1,15 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, String, TIMESTAMP, LargeBinary
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy import ForeignKey, String, TIMESTAMP, LargeBinary, Index, UniqueConstraint, DateTime, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, selectinload, undefer_group
 from sqlalchemy.sql import func
 from typing import Optional, List
+from replicas import RoutingSession
+from datetime import datetime
+import secrets
 
 # https://flask-sqlalchemy.palletsprojects.com/en/3.1.x/models/#initializing-the-base-class
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+# Sessions route the reads of read only routes to the replica, if there is one (see replicas.py)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 
 class User(db.Model):
@@ -21,11 +26,15 @@ class User(db.Model):
     password: Mapped[str]
     email: Mapped[str] = mapped_column(unique=True)
 
+    # Set when a large account is being deleted in the background (see account_deletion.py)
+    deleted_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True))
+
     # https://docs.sqlalchemy.org/en/20/tutorial/orm_related_objects.html#working-with-orm-related-objects
     # https://docs.sqlalchemy.org/en/20/orm/basic_relationships.html#basic-relationship-patterns
-    # A user can have many budgets hence List, back_populates the user attribute in the Budget class,
-    # delete all records of budgets if parent is deleted
-    budget: Mapped[List["Budget"]] = relationship(back_populates="user", cascade="all, delete")
+    # A user can have many budgets hence List, back_populates the user attribute in the Budget class.
+    # Budgets are deleted by the database when the user is (ON DELETE CASCADE), passive_deletes
+    # stops the ORM from loading them all first to delete them one by one
+    budget: Mapped[List["Budget"]] = relationship(back_populates="user", cascade="all, delete", passive_deletes=True)
 
     def __repr__(self) -> str:
         return f"""
@@ -38,20 +47,44 @@ class Budget(db.Model):
     __tablename__ = "budgets"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    budget: Mapped[Optional[bytes]] = mapped_column(LargeBinary())
-    result: Mapped[bytes] = mapped_column(LargeBinary())
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+
+    # The encrypted values are deferred, they're only loaded by the queries that decrypt them (see load_encrypted)
+    budget: Mapped[Optional[bytes]] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
+    result: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
     name: Mapped[str]
 
+    # All of the expenses packed and encrypted as a single blob, only used when the budget
+    # is stored in packed mode (see BUDGET_STORAGE in app.py), otherwise they're Expense rows
+    packed: Mapped[Optional[bytes]] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
+
     # https://stackoverflow.com/questions/76942961/specify-timestamp-column-type-hint-in-the-creation-of-a-table-using-sqlalchemy-a
     timestamp = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
+    # Bumped every time the budget is updated, used for ETag/Last-Modified so unchanged
+    # budgets can be answered with a 304 without loading or decrypting anything
+    version: Mapped[int] = mapped_column(nullable=False, default=1, server_default="1")
+    updated_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True))
+
+    # Random per budget and part of the ETag, SQLite hands the id of a deleted budget to the next
+    # one that's created, so without it a browser could get a 304 for a budget it never saw
+    nonce: Mapped[Optional[str]] = mapped_column(String(16), default=lambda: secrets.token_hex(8))
+
+    # Revision of the latest full copy in the revision log, None until the budget is first updated
+    revision_checkpoint: Mapped[Optional[int]]
+
     # back_populates uses the attribute name of the target table
     user: Mapped["User"] = relationship(back_populates="budget")
 
     # Adding a list of expenses, since multiple expenses can be associated with a single budget
-    # cascade behavior is set to delete all associated records when the parent is deleted
-    expenses: Mapped[List["Expense"]] = relationship(back_populates="budget", cascade="all, delete")
+    # the database deletes all associated records when the parent is deleted (ON DELETE CASCADE)
+    expenses: Mapped[List["Expense"]] = relationship(back_populates="budget", cascade="all, delete", passive_deletes=True)
+
+    # Per category totals, kept up to date when the budget is created or updated
+    summaries: Mapped[List["BudgetSummary"]] = relationship(back_populates="budget", cascade="all, delete", passive_deletes=True)
+
+    # Earlier versions of the budget (see revisions.py)
+    revisions: Mapped[List["BudgetRevision"]] = relationship(back_populates="budget", cascade="all, delete", passive_deletes=True)
 
     def __repr__(self) -> str:
         return f"""
@@ -64,12 +97,12 @@ class Expense(db.Model):
     __tablename__ = "expenses"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    budget_id: Mapped[int] = mapped_column(ForeignKey("budgets.id"))
+    budget_id: Mapped[int] = mapped_column(ForeignKey("budgets.id", ondelete="CASCADE"))
 
     # A list in app.py will define valid categories for more flexibility
     category: Mapped[str]
     note: Mapped[Optional[str]] = mapped_column(default="expense")
-    amount: Mapped[bytes] = mapped_column(LargeBinary())
+    amount: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
 
     budget: Mapped["Budget"] = relationship(back_populates="expenses")
 
@@ -80,5 +113,95 @@ class Expense(db.Model):
                 """
 
 
+class BudgetSummary(db.Model):
+    __tablename__ = "budget_summaries"
+
+    # One row per category of a budget, so the totals can be served without decrypting every expense
+    __table_args__ = (UniqueConstraint("budget_id", "category"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    budget_id: Mapped[int] = mapped_column(ForeignKey("budgets.id", ondelete="CASCADE"))
+    category: Mapped[str]
+
+    # Encrypted sum of the expense costs in the category, and the number of expenses
+    total: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
+    count: Mapped[int]
+
+    budget: Mapped["Budget"] = relationship(back_populates="summaries")
+
+    def __repr__(self) -> str:
+        return f"""
+                BudgetSummary(id={self.id!r}, budget_id={self.budget_id!r}, category={self.category!r},
+                total={self.total!r}, count={self.count!r})
+                """
+
+
+class BudgetRevision(db.Model):
+    __tablename__ = "budget_revisions"
+
+    # Append only log of the versions of a budget, the unique constraint doubles as the index for
+    # reading a range of revisions of a budget
+    __table_args__ = (UniqueConstraint("budget_id", "revision"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    budget_id: Mapped[int] = mapped_column(ForeignKey("budgets.id", ondelete="CASCADE"))
+
+    # The budget version this revision is of, and the revision of the full copy it's rebuilt from
+    # (the same as revision when this one is a full copy)
+    revision: Mapped[int]
+    checkpoint: Mapped[int]
+
+    # Encrypted, compressed JSON, either the whole budget or the changes since the previous revision
+    data: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True, deferred_group="encrypted")
+    created_at = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
+
+    budget: Mapped["Budget"] = relationship(back_populates="revisions")
+
+    def __repr__(self) -> str:
+        return f"""
+                BudgetRevision(id={self.id!r}, budget_id={self.budget_id!r}, revision={self.revision!r},
+                checkpoint={self.checkpoint!r}, data={self.data!r})
+                """
+
+
+class SessionRecord(db.Model):
+    __tablename__ = "user_sessions"
+
+    # Server side sessions for the "cached" session backend (see session_backends.py)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    session_id: Mapped[str] = mapped_column(String(255), unique=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary())
+
+    # Naive UTC, indexed so expired sessions can be cleaned up in batches
+    expiry: Mapped[datetime] = mapped_column(DateTime(), index=True)
+
+    def __repr__(self) -> str:
+        return f"SessionRecord(id={self.id!r}, session_id={self.session_id!r}, expiry={self.expiry!r})"
+
+
+# Indexes for the hot query paths, listing a users budgets by most recent first and loading the
+# expenses of a budget (create_tables.py migrate adds these to existing databases)
+Index("ix_budgets_user_id_timestamp", Budget.user_id, Budget.timestamp.desc())
+Index("ix_expenses_budget_id_category", Expense.budget_id, Expense.category)
+
+
+def load_encrypted(*relationships):
+
+    # Loader options for a query that decrypts a budget. The deferred encrypted columns are loaded with the
+    # budget, and each relationship is loaded up front (with its encrypted columns) in one SELECT ... IN,
+    # instead of a lazy load of the relationship followed by a query per row for its deferred column
+    return [undefer_group("encrypted")] + [selectinload(relationship).undefer_group("encrypted") for relationship in relationships]
+
+
+# SQLite only enforces foreign keys (and so ON DELETE CASCADE) when it's turned on for each connection
+# https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#foreign-key-support
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if "sqlite" in type(dbapi_connection).__module__:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 # Delete behavior for one to many
 # https://docs.sqlalchemy.org/en/20/orm/basic_relationships.html#configuring-delete-behavior-for-one-to-many
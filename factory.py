@@ -0,0 +1,70 @@
+import os
+
+from flask import Flask, Request, current_app
+from db_models import db
+from replicas import init_replica
+from pool_stats import engine_options
+from dotenv import load_dotenv
+
+
+class BudgetRequest(Request):
+
+    # Request bodies are limited to MAX_CONTENT_LENGTH, except the import which gets IMPORT_MAX_CONTENT_LENGTH.
+    # Anything bigger is answered with a 413 before it's read or parsed
+    @property
+    def max_content_length(self):
+        if self.endpoint == "import_budgets":
+            return current_app.config["IMPORT_MAX_CONTENT_LENGTH"]
+        return super().max_content_length
+
+
+def create_app(config=None):
+
+    # Creates the app with its database configured from the environment variables (and the .env file),
+    # shared by app.py and create_tables.py. Values in config take precedence over the environment.
+    # Only what both need is set up here: the routes, sessions, static files, caches, error handlers and the
+    # encryption key are bound to the single app in app.py, so this doesn't create a second usable web app.
+    # To run the web app against another database set DATABASE_URL before app.py is imported
+    # https://flask.palletsprojects.com/en/3.0.x/patterns/appfactories/
+    load_dotenv()
+
+    app = Flask(__name__)
+    app.request_class = BudgetRequest
+
+    # A budget at MAX_EXPENSES expenses with long names is around 100 KB
+    app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH", 256 * 1024))
+    app.config["IMPORT_MAX_CONTENT_LENGTH"] = int(os.getenv("IMPORT_MAX_CONTENT_LENGTH", 16 * 1024 * 1024))
+
+    # https://flask-sqlalchemy.palletsprojects.com/en/3.1.x/quickstart/#configure-the-extension
+    # configure SQLAlchemy db URI
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # The read only routes read from DATABASE_REPLICA_URL when it's set (same engine options as the primary).
+    # For REPLICA_STICKY_SECONDS after a user writes something their reads stay on the primary
+    app.config["DATABASE_REPLICA_URL"] = os.getenv("DATABASE_REPLICA_URL")
+    app.config["REPLICA_STICKY_SECONDS"] = float(os.getenv("REPLICA_STICKY_SECONDS", 10))
+
+    app.config.update(config or {})
+
+    # Connection pool: DB_POOL_SIZE connections are kept open, up to DB_MAX_OVERFLOW more under load, and a
+    # request waits at most DB_POOL_TIMEOUT seconds for one. Connections are replaced after DB_POOL_RECYCLE
+    # seconds (-1 never), DB_POOL_PRE_PING=1 tests them before use, DB_STATEMENT_TIMEOUT is in ms (PostgreSQL)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"],
+        pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", -1)),
+        pre_ping=os.getenv("DB_POOL_PRE_PING") == "1",
+        statement_timeout=os.getenv("DB_STATEMENT_TIMEOUT")
+        ))
+    # Display database queries and messages in the CLI
+    # app.config["SQLALCHEMY_ECHO"] = True
+
+    init_replica(app, app.config["DATABASE_REPLICA_URL"], app.config["REPLICA_STICKY_SECONDS"])
+
+    # Bind SQLAlchemy to the Flask app instance
+    db.init_app(app)
+
+    return app
@@ -0,0 +1,107 @@
+import time
+import threading
+
+from cachelib import SimpleCache, FileSystemCache, NullCache
+
+
+class FragmentCache:
+
+    # Cache of rendered template fragments, keyed per user. Entries expire after timeout seconds
+    # and the backend evicts entries once there are more than threshold of them.
+    # Backends: "simple" (in-process), "filesystem" (shared between workers) or "null" (disabled)
+
+    def __init__(self, backend="simple", timeout=300, threshold=500, cache_dir=None):
+
+        # https://cachelib.readthedocs.io/en/stable/
+        if backend == "simple":
+            self.cache = SimpleCache(threshold=threshold, default_timeout=timeout)
+        elif backend == "filesystem":
+            self.cache = FileSystemCache(cache_dir, threshold=threshold, default_timeout=timeout)
+        elif backend == "null":
+            self.cache = NullCache()
+        else:
+            raise ValueError(f"Unknown fragment cache backend: {backend}")
+
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _generation(self, user_id):
+
+        # Every key of a user includes their generation, so replacing it invalidates all of their
+        # fragments at once. The old entries are left for the backend to expire or evict.
+        # If the generation itself got evicted start a new one, an old one must never come back
+        generation = self.cache.get(f"generation:{user_id}")
+        if generation is None:
+            self.cache.add(f"generation:{user_id}", time.time_ns(), timeout=0)
+            generation = self.cache.get(f"generation:{user_id}")
+
+        return generation
+
+    def key(self, user_id, *parts):
+        return ":".join(str(part) for part in ["fragment", user_id, self._generation(user_id), *parts])
+
+    def get(self, key):
+
+        # Return the cached fragment, or None
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+
+        fragment, seconds = cached
+        with self._lock:
+            self.hits += 1
+
+            # A hit saves what it took to render the fragment in the first place
+            self.saved_seconds += seconds
+        return fragment
+
+    def set(self, key, fragment, seconds):
+
+        # Cache a fragment along with how long it took to render
+        self.cache.set(key, (fragment, seconds))
+        with self._lock:
+            self.misses += 1
+            self.render_seconds += seconds
+
+    def get_or_render(self, key, render):
+
+        # Return the cached fragment, or call render() and cache what it returns
+        fragment = self.get(key)
+        if fragment is None:
+            start = time.perf_counter()
+            fragment = render()
+            self.set(key, fragment, time.perf_counter() - start)
+
+        return fragment
+
+    async def get_or_render_async(self, key, render):
+
+        # Same as get_or_render, for async views where render is a coroutine function
+        fragment = self.get(key)
+        if fragment is None:
+            start = time.perf_counter()
+            fragment = await render()
+            self.set(key, fragment, time.perf_counter() - start)
+
+        return fragment
+
+    def invalidate_user(self, user_id):
+
+        # Drop every cached fragment of a user, called after anything they own is written
+        self.cache.set(f"generation:{user_id}", time.time_ns(), timeout=0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "render_seconds": self.render_seconds,
+                "saved_seconds": self.saved_seconds
+            }
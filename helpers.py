@@ -1,5 +1,29 @@
+import os
+import csv
+import json
+import math
+import base64
+import hashlib
+import struct
+import threading
+
 from flask import redirect, session, url_for, request
-from functools import wraps
+from functools import wraps, cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
+from cryptography.fernet import InvalidToken
+from instrumentation import timed
+
+
+# Batches smaller than this are handled serially, since the pool overhead isn't worth it
+BATCH_THRESHOLD = 64
+
+# Number of workers used by the crypto pools
+BATCH_WORKERS = os.cpu_count() or 1
+
+# Pools are created on first use and reused between requests
+_executors = {}
 
 
 def login_required(func):
@@ -19,45 +43,258 @@ def login_required(func):
     return decorated_function
 
 
-def form_data_error(form, valid_categories, max_len):
+def check_expenses(validator, max_len, instance, schema):
 
-    error = None
-    budget = form.get("info")
-    expenses = form.get("categories")
+    # Custom "expenses" keyword, checks the names and costs of a category in a single loop. Descending into a
+    # subschema for every expense made validating a budget with hundreds of expenses take tens of milliseconds
+    from jsonschema import ValidationError
 
-    # Check for budget name and collisions
-    if not budget.get("name"):
-        error = "Missing budget name"
-    elif form.get("collisions"):
-        error = "Expense name collision(s), use unique names"
-    elif not expenses:
-        error = "Missing categories"
-    elif len(budget.get("name")) > max_len:
-        error = "Budget name exceeds character limit (100)"
+    if not validator.is_type(instance, "object"):
+        return
+    for name, amount in instance.items():
+        if len(name) > max_len:
+            yield ValidationError(f"One or more expense names exceed character limit ({max_len})")
+            return
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+            yield ValidationError("One or more values could not be processed as float")
+            return
+        if not amount:
+            yield ValidationError("Missing cost value for one or more inputs")
+            return
 
-    # Check that categories and inputs fields are valid
-    for key in expenses.keys():
-        
-        # Check for valid categories
-        if not key or key not in valid_categories:
-            error = "Invalid categories"
 
-        # Check for valid category value (dict of expenses)
-        elif not expenses[key]:
-            error = "Invalid/missing input"
+@cache
+def schema_validator():
+
+    # Draft 2020-12 with the expenses keyword added. jsonschema is slow to import, so it's only imported
+    # when the first budget is validated rather than when the app starts
+    # https://python-jsonschema.readthedocs.io/en/stable/creating/
+    from jsonschema import Draft202012Validator, validators
+
+    return validators.extend(Draft202012Validator, {"expenses": check_expenses})
+
+
+class BudgetValidator:
+
+    # Validates the create/update form (and imported budgets) against a JSON schema that's compiled once, on first use.
+    # Every check in the schema carries the message shown to the user, validation stops at the first error.
+    # https://python-jsonschema.readthedocs.io/en/stable/validate/
+
+    def __init__(self, valid_categories, max_len, max_expenses):
+        self.max_expenses = max_expenses
+        self.schema = budget_schema(valid_categories, max_len, max_expenses)
+        self._validator = None
+        self._lock = threading.Lock()
+
+    def compile(self):
+        with self._lock:
+            if self._validator is None:
+                validator = schema_validator()
+                validator.check_schema(self.schema)
+                self._validator = validator(self.schema)
+        return self._validator
+
+    def error(self, form):
+
+        # The number of expenses is checked first, so an oversized budget is turned away without walking it
+        categories = form.get("categories") if isinstance(form, dict) else None
+        if isinstance(categories, dict):
+            count = sum(len(expenses) for expenses in categories.values() if isinstance(expenses, dict))
+            if count > self.max_expenses:
+                return f"Too many expenses, a budget can have at most {self.max_expenses}"
+
+        # iter_errors is lazy, only the first error is produced. The message comes from the failing part of
+        # the schema, the expenses keyword makes its own
+        error = next((self._validator or self.compile()).iter_errors(form), None)
+        if error is None:
+            return None
+        if error.validator == "expenses":
+            return error.message
+        return error.schema.get("message", "Invalid/missing input") if isinstance(error.schema, dict) else "Invalid/missing input"
+
 
-        # Check for valid cost input
-        for expense in expenses[key]:
+def budget_schema(valid_categories, max_len, max_expenses):
 
-            # Check character length of expense
-            if len(expense) > max_len:
-                error = "One or more expense names exceed character limit (100)"
+    # Checks are evaluated in order, the messages match the ones script.js shows for the same mistakes
+    number = "One or more values could not be processed as float"
+    return {
+        "type": "object",
+        "required": ["info", "categories"],
+        "message": "Invalid budget structure",
+        "properties": {
+            "info": {
+                "type": "object",
+                "required": ["name"],
+                "message": "Missing budget name",
+                "properties": {
+                    "name": {
+                        "allOf": [
+                            {"type": "string", "minLength": 1, "message": "Missing budget name"},
+                            {"maxLength": max_len, "message": f"Budget name exceeds character limit ({max_len})"}
+                        ]
+                    },
+                    "total": {"type": ["number", "null"], "message": number},
+                    "result": {"type": ["number", "null"], "message": number},
+                    "id": {"type": ["integer", "string", "null"], "message": "Budget could not be found"}
+                }
+            },
+            "collisions": {"enum": [False, None], "message": "Expense name collision(s), use unique names"},
+            "categories": {
+                "allOf": [
+                    {"type": "object", "minProperties": 1, "message": "Missing categories"},
+                    {"propertyNames": {"enum": list(valid_categories), "message": "Invalid categories"}},
+                    {
+                        "additionalProperties": {
+                            "type": "object",
+                            "minProperties": 1,
+                            "maxProperties": max_expenses,
+                            "message": "Invalid/missing input",
+                            "expenses": max_len
+                        }
+                    }
+                ]
+            },
+            "ids": {"type": "object", "message": "Invalid/missing input"}
+        }
+    }
+
+
+def diff_expenses(existing, expenses, ids=None):
+
+    # Work out the changes needed to turn the existing Expense rows into the submitted
+    # {category: {expense: amount}}. Rows are matched by the id the client sent back in ids
+    # ({category: {expense: id}}), then by category and name for rows without one.
+    # Returns (matched, inserts, deletes), matched being (expense row, (category, note, amount)) pairs
+    ids = ids if isinstance(ids, dict) else {}
+    unclaimed = {expense.id: expense for expense in existing}
+    by_name = {(expense.category, expense.note): expense.id for expense in existing}
+
+    matched = []
+    pending = []
+    for category in expenses.keys():
+        category_ids = ids.get(category) if isinstance(ids.get(category), dict) else {}
+        for note, amount in expenses[category].items():
+            id = category_ids.get(note)
+            if isinstance(id, int) and id in unclaimed:
+                matched.append((unclaimed.pop(id), (category, note, amount)))
+            else:
+                pending.append((category, note, amount))
+
+    # Ids take priority, so only fall back to matching by name once they're all claimed
+    inserts = []
+    for category, note, amount in pending:
+        id = by_name.get((category, note))
+        if id in unclaimed:
+            matched.append((unclaimed.pop(id), (category, note, amount)))
+        else:
+            inserts.append((category, note, amount))
+
+    return matched, inserts, list(unclaimed.values())
+
+
+def summarize_expenses(expenses):
+
+    # Total and count of the expenses per category, {category: (total, count)}
+    # The totals are rounded to cents so floating point noise doesn't show up
+    return {
+        category: (round(sum(float(amount) for amount in expenses[category].values()), 2), len(expenses[category]))
+        for category in expenses.keys()
+    }
+
+
+def encode_cursor(timestamp, id):
+
+    # Opaque cursor for keyset pagination, the position of the last row that was returned
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+
+    # Returns the (timestamp, id) a cursor points at, raises ValueError if it's malformed
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(id)
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
 
-            amount = expenses[key][expense]
-            if not amount:
-                error = "Missing cost value for one or more inputs"
 
-    return error
+# Columns of the CSV export, one row per expense
+EXPORT_COLUMNS = ["budget", "name", "total", "result", "timestamp", "category", "expense", "amount"]
+
+
+def read_ndjson(lines):
+
+    # Parse an NDJSON export one line at a time, each line is a budget in the same structure the
+    # create form sends. Yields (line number, form), raises ValueError for lines that aren't JSON
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {number}: invalid JSON")
+
+
+def read_csv(lines):
+
+    # Parse a CSV export one row at a time, consecutive rows of the same budget are grouped into a form.
+    # Yields (line number of the budget's first row, form), raises ValueError if columns are missing
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None or not set(EXPORT_COLUMNS) <= set(reader.fieldnames):
+        raise ValueError(f"Missing columns, expected: {', '.join(EXPORT_COLUMNS)}")
+
+    current, form, start = None, None, None
+    for row in reader:
+        if form is None or row["budget"] != current:
+            if form is not None:
+                yield start, form
+            current, start = row["budget"], reader.line_num
+            form = {"info": {"name": row["name"], "total": row["total"], "result": row["result"]}, "categories": {}}
+        form["categories"].setdefault(row["category"], {})[row["expense"]] = row["amount"]
+
+    if form is not None:
+        yield start, form
+
+
+def convert_import_form(form):
+
+    # Imported budgets come from a file rather than the create form, so check the structure and convert
+    # the numbers. Returns a new form with float values, raises ValueError with the message shown to the user
+    if not isinstance(form, dict) or not isinstance(form.get("info"), dict) \
+            or not isinstance(form.get("info").get("name"), str) or not isinstance(form.get("categories"), dict) \
+            or not all(isinstance(expenses, dict) for expenses in form["categories"].values()):
+        raise ValueError("Invalid budget structure")
+
+    info = form["info"]
+    try:
+        info = dict(
+            info,
+            total=float(info["total"]) if info.get("total") not in (None, "") else None,
+            result=float(info.get("result"))
+            )
+        categories = {
+            category: {expense: float(amount) for expense, amount in expenses.items()}
+            for category, expenses in form["categories"].items()
+        }
+    except (TypeError, ValueError):
+        raise ValueError("One or more values could not be processed as float") from None
+
+    values = [info["total"] or 0, info["result"]] + [amount for expenses in categories.values() for amount in expenses.values()]
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError("One or more values could not be processed as float")
+
+    return dict(form, info=info, categories=categories)
+
+
+def import_form_error(form, validator):
+
+    # Convert an imported budget and apply the same checks as the create form, returns the error or None
+    try:
+        form = convert_import_form(form)
+    except ValueError as e:
+        return str(e)
+
+    return validator.error(form)
 
 
 def escape_chars(text):
@@ -84,6 +321,7 @@ def escape_chars(text):
     return text
 
 
+@timed("crypto")
 def encrypt_data(data, key):
 
     # If data is none, don't encrypt it
@@ -99,6 +337,7 @@ def encrypt_data(data, key):
     return encrypted_data
 
 
+@timed("crypto")
 def decrypt_data(data, key):
 
     try:
@@ -107,4 +346,287 @@ def decrypt_data(data, key):
         return None
     
     # Returns string
-    return decrypted_data
\ No newline at end of file
+    return decrypted_data
+
+
+def _get_executor(mode):
+
+    # Create the pool the first time it's asked for
+    if mode not in _executors:
+        if mode == "process":
+            _executors[mode] = ProcessPoolExecutor(max_workers=BATCH_WORKERS)
+        elif mode == "thread":
+            _executors[mode] = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="crypto")
+        else:
+            raise ValueError(f"Unknown executor mode: {mode}")
+
+    return _executors[mode]
+
+
+def _encrypt_chunk(chunk, key):
+    return [encrypt_data(data, key) for data in chunk]
+
+
+def _decrypt_chunk(chunk, key):
+    return [decrypt_data(data, key) for data in chunk]
+
+
+def _rotate_chunk(chunk, key):
+    return [key.rotate(data) if data else None for data in chunk]
+
+
+def _run_batch(func, items, key, mode, threshold):
+
+    items = list(items)
+
+    # Small batches (or serial mode) aren't worth sending to a pool
+    if mode == "serial" or not items or len(items) < threshold:
+        return func(items, key)
+
+    # Split into one chunk per worker so each task does a meaningful amount of work,
+    # then stitch the results back together in the original order
+    size = -(-len(items) // BATCH_WORKERS)
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    results = []
+    for chunk in _get_executor(mode).map(func, chunks, [key] * len(chunks)):
+        results.extend(chunk)
+
+    return results
+
+
+@timed("crypto")
+def encrypt_batch(data, key, mode="thread", threshold=BATCH_THRESHOLD, cache=None):
+
+    # Same as encrypt_data but for a list of values, returns a list of byte strings (or None)
+    # in the same order. Mode can be "serial", "thread" or "process"
+    data = list(data)
+    encrypted = _run_batch(_encrypt_chunk, data, key, mode, threshold)
+
+    # The plaintext is already known, so store it to save decrypting the new tokens later
+    if cache is not None:
+        for token, value in zip(encrypted, data):
+            if token is not None:
+                cache.set(token, str(value))
+
+    return encrypted
+
+
+@timed("crypto")
+def decrypt_batch(data, key, mode="thread", threshold=BATCH_THRESHOLD, cache=None):
+
+    # Same as decrypt_data but for a list of tokens, returns a list of strings (or None)
+    # in the same order. Mode can be "serial", "thread" or "process"
+    data = list(data)
+    if cache is None:
+        return _run_batch(_decrypt_chunk, data, key, mode, threshold)
+
+    # Only decrypt the tokens that aren't cached already
+    decrypted = [cache.get(token) if token else None for token in data]
+    missing = [i for i, value in enumerate(decrypted) if value is None and data[i]]
+    if missing:
+        for i, value in zip(missing, _run_batch(_decrypt_chunk, [data[i] for i in missing], key, mode, threshold)):
+            decrypted[i] = value
+            if value is not None:
+                cache.set(data[i], value)
+
+    return decrypted
+
+
+def rotate_batch(data, key, mode="thread", threshold=BATCH_THRESHOLD):
+
+    # Re-encrypt a list of tokens with the primary key of a MultiFernet, they can be encrypted with any of
+    # its keys. Returns the new tokens in the same order (None stays None), the original timestamps are kept
+    return _run_batch(_rotate_chunk, list(data), key, mode, threshold)
+
+
+# Version byte at the start of packed payloads, in case the format needs to change
+PACKED_VERSION = 1
+
+
+def _pack_varint(value):
+
+    # Unsigned LEB128, small numbers (most lengths and counts) only take a single byte
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _unpack_varint(payload, pos):
+
+    value = shift = 0
+    while True:
+        byte = payload[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _pack_string(text):
+    encoded = text.encode()
+    return _pack_varint(len(encoded)) + encoded
+
+
+def _unpack_string(payload, pos):
+    length, pos = _unpack_varint(payload, pos)
+    return payload[pos:pos + length].decode(), pos + length
+
+
+def pack_expenses(categories):
+
+    # Serialize {category: {expense: amount}} into a compact binary payload:
+    # version, category count, then for each category its name, expense count and
+    # each expense name followed by the amount as a 64 bit float
+    out = bytearray([PACKED_VERSION])
+    out += _pack_varint(len(categories))
+    for category, expenses in categories.items():
+        out += _pack_string(category)
+        out += _pack_varint(len(expenses))
+        for expense, amount in expenses.items():
+            out += _pack_string(expense)
+            out += struct.pack("<d", float(amount))
+
+    return bytes(out)
+
+
+def unpack_expenses(payload):
+
+    # Reverse of pack_expenses, raises ValueError if the payload can't be read
+    try:
+        if payload[0] != PACKED_VERSION:
+            raise ValueError(f"Unknown packed version: {payload[0]}")
+
+        categories = {}
+        count, pos = _unpack_varint(payload, 1)
+        for _ in range(count):
+            category, pos = _unpack_string(payload, pos)
+            expenses = categories.setdefault(category, {})
+            num_expenses, pos = _unpack_varint(payload, pos)
+            for _ in range(num_expenses):
+                expense, pos = _unpack_string(payload, pos)
+                expenses[expense] = struct.unpack_from("<d", payload, pos)[0]
+                pos += 8
+    except (IndexError, struct.error, UnicodeError) as e:
+        raise ValueError("Packed expenses could not be read") from e
+
+    return categories
+
+
+@timed("crypto")
+def encrypt_packed(categories, key, cache=None):
+
+    # Pack all of a budget's expenses and encrypt them as a single token
+    payload = pack_expenses(categories)
+    token = key.encrypt(payload)
+    if cache is not None:
+        cache.set(token, payload)
+
+    return token
+
+
+@timed("crypto")
+def decrypt_packed(token, key, cache=None):
+
+    # Decrypt and unpack a token created by encrypt_packed, returns None if it can't be decrypted
+    payload = cache.get(token) if cache is not None else None
+    if payload is None:
+        try:
+            payload = key.decrypt(token)
+        except (TypeError, InvalidToken):
+            return None
+        if cache is not None:
+            cache.set(token, payload)
+
+    return unpack_expenses(payload)
+
+
+class DecryptCache:
+
+    # Maps a digest of the ciphertext to its decrypted value, Fernet tokens are never
+    # modified so a token will always decrypt to the same value. The least recently used
+    # entries are evicted once the estimated size goes above max_bytes
+
+    # Rough memory cost of an entry on top of the value itself (digest, dict node, str object)
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token).digest()
+
+    def _entry_size(self, value):
+        return self.ENTRY_OVERHEAD + len(value)
+
+    def get(self, token):
+
+        digest = self._digest(token)
+        with self._lock:
+            value = self._entries.get(digest)
+            if value is None:
+                self.misses += 1
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return value
+
+    def set(self, token, value):
+
+        digest = self._digest(token)
+        with self._lock:
+            if digest in self._entries:
+                self.size -= self._entry_size(self._entries.pop(digest))
+
+            self._entries[digest] = value
+            self.size += self._entry_size(value)
+
+            # Evict least recently used entries until back under the limit
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self._entry_size(evicted)
+                self.evictions += 1
+
+    def invalidate(self, tokens):
+
+        # Remove the entries for tokens that are being replaced or deleted
+        with self._lock:
+            for token in tokens:
+                if not token:
+                    continue
+                value = self._entries.pop(self._digest(token), None)
+                if value is not None:
+                    self.size -= self._entry_size(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
\ No newline at end of file
@@ -0,0 +1,188 @@
+import bisect
+import logging
+import threading
+import time
+
+from functools import wraps
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# Histogram buckets, seconds for timings and a plain count for queries
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100]
+
+# Parts of a request that are timed separately
+COMPONENTS = ["db", "crypto", "render"]
+
+# Most statements kept per request for the slow request log
+MAX_STATEMENTS = 100
+
+
+def timed(component):
+
+    # Decorator adding the time spent in a function to the current request. Nested timed calls
+    # (e.g. a batch that calls encrypt_data) only count once, outside a request it does nothing
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not has_request_context() or "_timings" not in g or g._timing_depth:
+                return func(*args, **kwargs)
+
+            g._timing_depth += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                g._timings[component] += time.perf_counter() - start
+                g._timing_depth -= 1
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram:
+
+    # Prometheus style histogram, cumulative buckets are worked out when exported
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bucket}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Instrumentation:
+
+    # Times every request and splits it into SQL, encryption/decryption and template rendering, and
+    # counts the queries. Results are kept as per route histograms for /metrics (Prometheus text format),
+    # can be sent to the browser in a Server-Timing header, and requests slower than slow_ms
+    # are logged along with the statements they executed
+
+    def __init__(self, app=None, server_timing=False, slow_ms=500):
+        self.server_timing = server_timing
+        self.slow_ms = slow_ms
+        self.histograms = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.extensions["instrumentation"] = self
+
+    def attach_engine(self, engine):
+
+        # https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _start(self):
+        g._request_start = time.perf_counter()
+        g._timings = dict.fromkeys(COMPONENTS, 0.0)
+        g._timing_depth = 0
+        g._statements = []
+        g._queries = 0
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+
+        # The start is kept on the statement's execution context, which is thrown away with it,
+        # so a statement that raises (and never gets to after_cursor_execute) leaves nothing behind
+        context._query_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._query_start
+        if has_request_context() and "_timings" in g:
+            g._timings["db"] += seconds
+            g._queries += 1
+            if len(g._statements) < MAX_STATEMENTS:
+                g._statements.append((statement, seconds))
+
+    def _before_render(self, app, template, context, **extra):
+        if "_timings" in g:
+            g._render_start = time.perf_counter()
+
+    def _after_render(self, app, template, context, **extra):
+        if "_render_start" in g:
+            g._timings["render"] += time.perf_counter() - g.pop("_render_start")
+
+    def _finish(self, response):
+
+        if "_request_start" not in g:
+            return response
+
+        total = time.perf_counter() - g._request_start
+        route = request.endpoint or "unmatched"
+
+        with self._lock:
+            self.requests[(route, response.status_code)] = self.requests.get((route, response.status_code), 0) + 1
+            histograms = self.histograms.get(route)
+            if histograms is None:
+                histograms = self.histograms[route] = {
+                    "duration": Histogram(TIME_BUCKETS),
+                    **{component: Histogram(TIME_BUCKETS) for component in COMPONENTS},
+                    "queries": Histogram(QUERY_BUCKETS)
+                }
+            histograms["duration"].observe(total)
+            for component in COMPONENTS:
+                histograms[component].observe(g._timings[component])
+            histograms["queries"].observe(g._queries)
+
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+        if self.server_timing:
+            timings = [f'{component};dur={g._timings[component] * 1000:.2f}' for component in COMPONENTS]
+            timings[0] += f';desc="{g._queries} queries"'
+            response.headers["Server-Timing"] = ", ".join(timings + [f"total;dur={total * 1000:.2f}"])
+
+        if total * 1000 >= self.slow_ms:
+            self.logger.warning(
+                "Slow request %s %s (%s) %.1f ms: db %.1f ms in %d queries, crypto %.1f ms, render %.1f ms\n%s",
+                request.method, request.path, route, total * 1000, g._timings["db"] * 1000, g._queries,
+                g._timings["crypto"] * 1000, g._timings["render"] * 1000,
+                "\n".join(f"  {seconds * 1000:.1f} ms  {' '.join(statement.split())}" for statement, seconds in g._statements)
+                )
+
+        return response
+
+    def metrics(self):
+
+        # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+        lines = [
+            "# HELP budget_requests_total Requests handled, by route and status",
+            "# TYPE budget_requests_total counter"
+        ]
+        with self._lock:
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'budget_requests_total{{route="{route}",status="{status}"}} {count}')
+
+            for name, help in [
+                ("duration", "Total time spent handling the request"),
+                ("db", "Time spent executing SQL"),
+                ("crypto", "Time spent encrypting and decrypting"),
+                ("render", "Time spent rendering templates"),
+                ("queries", "SQL statements executed")
+            ]:
+                metric = "budget_request_queries" if name == "queries" else f"budget_request_{name}_seconds"
+                lines += [f"# HELP {metric} {help}, per request", f"# TYPE {metric} histogram"]
+                for route, histograms in sorted(self.histograms.items()):
+                    lines += histograms[name].lines(metric, f'route="{route}"')
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,89 @@
+import argparse
+
+from app import app, KEY, CRYPTO_MODE
+from db_models import *
+from create_tables import migrate
+from helpers import decrypt_batch, encrypt_batch, encrypt_packed, decrypt_packed
+
+
+# Number of budgets converted per transaction
+CHUNK_SIZE = 100
+
+
+def pack(budget):
+
+    # Group the decrypted expense rows by category
+    amounts = decrypt_batch([expense.amount for expense in budget.expenses], KEY, CRYPTO_MODE)
+    categories = {}
+    for expense, amount in zip(budget.expenses, amounts):
+        categories.setdefault(expense.category, {})[expense.note] = float(amount)
+
+    size = sum(len(expense.amount) for expense in budget.expenses)
+    budget.packed = encrypt_packed(categories, KEY)
+    for expense in budget.expenses:
+        db.session.delete(expense)
+
+    return size, len(budget.packed)
+
+
+def unpack(budget):
+
+    # Turn the packed token back into one Expense row per expense
+    categories = decrypt_packed(budget.packed, KEY)
+    rows = [(category, note, amount) for category in categories for note, amount in categories[category].items()]
+    encrypted = encrypt_batch([amount for _, _, amount in rows], KEY, CRYPTO_MODE)
+    for (category, note, _), amount in zip(rows, encrypted):
+        db.session.add(Expense(budget_id=budget.id, category=category, note=note, amount=amount))
+
+    size = len(budget.packed)
+    budget.packed = None
+
+    return size, sum(len(amount) for amount in encrypted)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert budgets between row and packed expense storage")
+    parser.add_argument("--unpack", action="store_true", help="convert packed budgets back to expense rows")
+    args = parser.parse_args()
+
+    # Databases created before the packed column existed get it (and anything else that's missing) first
+    migrate()
+
+    # Budgets that still need converting
+    if args.unpack:
+        condition, convert = Budget.packed.is_not(None), unpack
+    else:
+        condition, convert = Budget.packed.is_(None), pack
+
+    converted = before = after = 0
+    last_id = 0
+
+    # Walk the budgets in id order a chunk at a time, committing after each chunk
+    while True:
+        budgets = db.session.execute(
+            db.select(Budget)
+            .options(*load_encrypted(Budget.expenses))
+            .where(condition & (Budget.id > last_id))
+            .order_by(Budget.id)
+            .limit(CHUNK_SIZE)
+            ).scalars().all()
+        if not budgets:
+            break
+
+        for budget in budgets:
+            size_before, size_after = convert(budget)
+            before += size_before
+            after += size_after
+            converted += 1
+
+        last_id = budgets[-1].id
+        db.session.commit()
+
+    print(f"Converted {converted} budgets, expense data {before} bytes -> {after} bytes")
+
+
+if __name__ == "__main__":
+    # Queries require an application context, since there's no request, create one
+    with app.app_context():
+        main()
@@ -0,0 +1,80 @@
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordPoolBusy(Exception):
+
+    # Raised when too many hashes are already queued, or a hash took longer than the timeout,
+    # so the request can fail fast instead of tying up a worker
+    pass
+
+
+class PasswordHasher:
+
+    # Hashes and verifies passwords on a bounded pool, so the slow KDF doesn't run on the request
+    # workers. At most workers + max_queue hashes are in flight, any more raise PasswordPoolBusy.
+    # Mode can be "process", "thread" or "inline" (no pool, hashes in the calling thread)
+
+    def __init__(self, method="scrypt", mode="process", workers=2, max_queue=8, timeout=10):
+        self.method = method
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._prefix = None
+
+    def _get_executor(self):
+
+        # Create the pool the first time it's needed
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            elif self.mode == "thread":
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="passwords")
+            else:
+                raise ValueError(f"Unknown password pool mode: {self.mode}")
+
+        return self._executor
+
+    def _run(self, func, *args):
+
+        if self.mode == "inline":
+            return func(*args)
+
+        # Don't wait for a slot, if the queue is full the pool is already behind
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # The slot is given back when the hash is done rather than when this request stops waiting,
+        # a hash that timed out still occupies the pool until it finishes
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+
+            # Cancel it if it hasn't started yet, then answer like a full queue (503)
+            future.cancel()
+            raise PasswordPoolBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+
+        # Hashes start with the method and its parameters (e.g. "scrypt:32768:8:1$..."), if they don't
+        # match the configured ones the hash should be upgraded the next time the password is known
+        if self._prefix is None:
+            self._prefix = generate_password_hash("", self.method).split("$")[0]
+
+        return pwhash.split("$")[0] != self._prefix
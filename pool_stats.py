@@ -0,0 +1,162 @@
+import time
+import threading
+
+from collections import deque
+from sqlalchemy import event, make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=-1, pre_ping=False,
+                   statement_timeout=None):
+
+    # Options for SQLALCHEMY_ENGINE_OPTIONS, the defaults are SQLAlchemy's own.
+    # https://docs.sqlalchemy.org/en/20/core/pooling.html
+    options = {
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pre_ping
+    }
+
+    # SQLite in memory is left on the StaticPool Flask-SQLAlchemy gives it (a single connection that
+    # holds the database), it doesn't take the queue pool options
+    url = make_url(url)
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update({
+            "poolclass": TimedQueuePool,
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_timeout": pool_timeout
+        })
+
+    # Statement timeout in milliseconds, set on each new connection. Only PostgreSQL has one,
+    # it's ignored for other databases
+    if statement_timeout and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={int(statement_timeout)}"}
+
+    return options
+
+
+class TimedQueuePool(QueuePool):
+
+    # QueuePool that reports how long each checkout took (waiting for a free connection,
+    # connecting, pre-ping) to the PoolStats attached to it
+    stats = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            if self.stats is not None:
+                self.stats.timeout()
+            raise
+
+        if self.stats is not None:
+            self.stats.checkout(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+
+        # engine.dispose() replaces the pool, keep reporting to the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class PoolStats:
+
+    # Connection pool telemetry: checkout latency (of the last samples checkouts), connections in use
+    # and churn (connections opened, closed and invalidated)
+
+    def __init__(self, samples=1000):
+        self.pool = None
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+        self._latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+
+        # Pool events registered on the engine carry over when the pool is recreated
+        # https://docs.sqlalchemy.org/en/20/core/events.html#connection-pool-events
+        self.pool = engine.pool
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.stats = self
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "close", self._on_close)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+        # Keep the stats pointing at the current pool after engine.dispose()
+        event.listen(engine, "engine_disposed", lambda engine: setattr(self, "pool", engine.pool))
+
+    def checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self._latencies.append(seconds)
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def _on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.closes += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+            def percentile(p):
+                return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+            stats = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "connects": self.connects,
+                "closes": self.closes,
+                "invalidations": self.invalidations,
+                "checkout_ms": {
+                    "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "p99": percentile(0.99),
+                    "max": latencies[-1] * 1000 if latencies else 0.0
+                }
+            }
+
+        # What the pool itself reports, overflow is negative while fewer than pool_size connections are open
+        if isinstance(self.pool, QueuePool):
+            stats.update({
+                "size": self.pool.size(),
+                "checked_out": self.pool.checkedout(),
+                "overflow": self.pool.overflow()
+            })
+
+        return stats
@@ -0,0 +1,72 @@
+import time
+
+from functools import wraps
+from flask import g, session, current_app, has_request_context
+from flask_sqlalchemy.session import Session
+
+
+# Bind key of the replica engine in SQLALCHEMY_BINDS
+REPLICA = "replica"
+
+
+class RoutingSession(Session):
+
+    # Session that sends the reads of read only routes to the replica (when one is configured), everything
+    # else goes to the primary. Writes are recorded, so the user's next reads can stay on the primary
+    # https://docs.sqlalchemy.org/en/20/orm/persistence_techniques.html#custom-vertical-partitioning
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, "is_dml", False):
+                g.db_wrote = True
+            elif g.get("use_replica") and REPLICA in self._db.engines:
+                return self._db.engines[REPLICA]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(func):
+
+    # Decorate routes that only read, their queries go to the replica unless the user wrote something
+    # within the last REPLICA_STICKY_SECONDS, so they always see their own changes (read your writes)
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        wrote_at = session.get("wrote_at")
+        g.use_replica = wrote_at is None or time.time() - wrote_at > current_app.config["REPLICA_STICKY_SECONDS"]
+        return func(*args, **kwargs)
+
+    return decorated_function
+
+
+def mark_write():
+
+    # For writes that don't go through the routing session (the async views)
+    g.db_wrote = True
+
+
+def init_replica(app, url, sticky_seconds=10):
+
+    # Add the replica as a bind, SQLALCHEMY_ENGINE_OPTIONS only applies to the primary so they're copied
+    app.config["REPLICA_STICKY_SECONDS"] = sticky_seconds
+    if not url:
+        return
+
+    app.config.setdefault("SQLALCHEMY_BINDS", {})[REPLICA] = {
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}), "url": url
+        }
+
+    remember_writes(app)
+
+
+def remember_writes(app):
+
+    # Store the time of a user's last write in their session. Only registered when there's a replica
+    # (sync or async), without one it would change and write the session on every write for nothing
+    if app.extensions.get("remember_writes"):
+        return
+    app.extensions["remember_writes"] = True
+
+    @app.after_request
+    def remember_write(response):
+        if g.get("db_wrote"):
+            session["wrote_at"] = time.time()
+        return response
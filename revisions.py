@@ -0,0 +1,170 @@
+import json
+import zlib
+
+from cryptography.fernet import InvalidToken
+from db_models import db, BudgetRevision
+from instrumentation import timed
+
+
+# Scalar fields of a budget, the expenses are diffed per category and name
+FIELDS = ("name", "total", "result")
+
+
+def budget_state(info, categories):
+
+    # What's stored of a budget, the same values as the create/update form
+    return {"name": info.get("name"), "total": info.get("total"), "result": info.get("result"), "categories": categories}
+
+
+def diff_states(old, new):
+
+    # The changes that turn old into new: the scalar fields that changed, expenses that were added or
+    # changed under "set" ({category: {expense: amount}}) and the ones that were removed under "del"
+    # ({category: [expense]}). Budgets usually change a few expenses at a time, so this stays small
+    delta = {field: new[field] for field in FIELDS if new[field] != old[field]}
+
+    changed = {}
+    for category, expenses in new["categories"].items():
+        previous = old["categories"].get(category, {})
+        for expense, amount in expenses.items():
+            if expense not in previous or previous[expense] != amount:
+                changed.setdefault(category, {})[expense] = amount
+
+    removed = {}
+    for category, expenses in old["categories"].items():
+        current = new["categories"].get(category, {})
+        gone = [expense for expense in expenses if expense not in current]
+        if gone:
+            removed[category] = gone
+
+    if changed:
+        delta["set"] = changed
+    if removed:
+        delta["del"] = removed
+
+    return delta
+
+
+def apply_delta(state, delta):
+
+    # Reverse of diff_states, state is changed in place
+    for field in FIELDS:
+        if field in delta:
+            state[field] = delta[field]
+
+    categories = state["categories"]
+    for category, expenses in delta.get("del", {}).items():
+        for expense in expenses:
+            categories[category].pop(expense, None)
+        if not categories[category]:
+            del categories[category]
+    for category, expenses in delta.get("set", {}).items():
+        categories.setdefault(category, {}).update(expenses)
+
+    return state
+
+
+def serialize(payload):
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+@timed("crypto")
+def encrypt_revision(data, key):
+
+    # Compressed before encrypting, ciphertext doesn't compress
+    return key.encrypt(zlib.compress(data))
+
+
+@timed("crypto")
+def decrypt_revisions(tokens, key):
+
+    # Revisions are rarely read, so they're decrypted serially and kept out of the decrypt cache.
+    # Raises ValueError if one can't be decrypted or read
+    try:
+        return [json.loads(zlib.decompress(key.decrypt(token))) for token in tokens]
+    except (TypeError, InvalidToken, zlib.error) as e:
+        raise ValueError("Revision could not be decrypted") from e
+
+
+def plan_revisions(budget, old_version, old, new, interval, key):
+
+    # Rows to add to the log for an update of budget from version old_version (state old) to state new,
+    # as values for an executemany INSERT (ORM inserts with RETURNING go one row at a time on SQLite).
+    # Every revision is stored as the changes since the previous one, except that a full copy (a checkpoint)
+    # is stored when the last one is interval revisions back, or when the changes wouldn't be any smaller.
+    # Rebuilding a revision therefore never takes more than interval - 1 deltas. budget.revision_checkpoint
+    # is moved forward when a checkpoint is added
+    rows = []
+    checkpoint = budget.revision_checkpoint
+
+    # The log starts at the first update, with a full copy of the budget as it was before it
+    if checkpoint is None:
+        checkpoint = old_version
+        rows.append({
+            "budget_id": budget.id, "revision": checkpoint, "checkpoint": checkpoint,
+            "data": encrypt_revision(serialize(old), key)
+        })
+
+    revision = old_version + 1
+    full = serialize(new)
+    delta = serialize(diff_states(old, new))
+    full_copy = revision - checkpoint >= interval or len(delta) >= len(full)
+    if full_copy:
+        checkpoint = revision
+    rows.append({
+        "budget_id": budget.id, "revision": revision, "checkpoint": checkpoint,
+        "data": encrypt_revision(full if full_copy else delta, key)
+    })
+
+    if budget.revision_checkpoint != checkpoint:
+        budget.revision_checkpoint = checkpoint
+
+    return rows
+
+
+def revision_list_query(budget_id):
+
+    # The revisions of a budget, newest first, without loading their data
+    return (
+        db.select(
+            BudgetRevision.revision, BudgetRevision.checkpoint, BudgetRevision.created_at,
+            db.func.length(BudgetRevision.data).label("size")
+            )
+        .where(BudgetRevision.budget_id == budget_id)
+        .order_by(BudgetRevision.revision.desc())
+        )
+
+
+def revision_chain_query(budget_id, revision):
+
+    # The checkpoint a revision is rebuilt from and the deltas after it up to the revision, in a single
+    # range scan of the (budget_id, revision) index
+    checkpoint = (
+        db.select(BudgetRevision.checkpoint)
+        .where((BudgetRevision.budget_id == budget_id) & (BudgetRevision.revision == revision))
+        .scalar_subquery()
+        )
+    return (
+        db.select(BudgetRevision.revision, BudgetRevision.checkpoint, BudgetRevision.data)
+        .where(
+            (BudgetRevision.budget_id == budget_id) &
+            (BudgetRevision.revision >= checkpoint) &
+            (BudgetRevision.revision <= revision)
+            )
+        .order_by(BudgetRevision.revision)
+        )
+
+
+def rebuild_revision(rows, key):
+
+    # The state of a budget at the last of rows (from revision_chain_query), None if there's no such revision.
+    # Raises ValueError if the data can't be decrypted or read
+    if not rows or rows[0].revision != rows[0].checkpoint:
+        return None
+
+    payloads = decrypt_revisions([row.data for row in rows], key)
+    state = payloads[0]
+    for delta in payloads[1:]:
+        apply_delta(state, delta)
+
+    return state
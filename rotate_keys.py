@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+
+from sqlalchemy import bindparam
+from cryptography.fernet import InvalidToken
+from app import app, KEY, CRYPTO_MODE
+from db_models import *
+from helpers import rotate_batch
+
+
+# Every encrypted column, by table
+COLUMNS = {
+    Budget.__table__: ["budget", "result", "packed"],
+    Expense.__table__: ["amount"],
+    BudgetSummary.__table__: ["total"],
+    BudgetRevision.__table__: ["data"]
+}
+
+
+def key_id():
+
+    # Identifies the key being rotated to, so a checkpoint from an earlier rotation isn't resumed
+    return hashlib.sha256(os.getenv("SECRET_KEY").encode()).hexdigest()[:16]
+
+
+def load_checkpoint(path):
+
+    # The last id that was re-encrypted in each table
+    if os.path.exists(path):
+        with open(path) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get("key") == key_id():
+            return checkpoint
+        print("Checkpoint is from a rotation to a different key, starting over")
+
+    return {"key": key_id(), "tables": {}}
+
+
+def save_checkpoint(path, checkpoint):
+
+    # Write to a temporary file and rename it, so an interruption never leaves half a checkpoint
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(path + ".tmp", path)
+
+
+def rotate_chunk(table, columns, rows):
+
+    # Re-encrypt every value of the chunk in one parallel batch
+    tokens = [row._mapping[column] for row in rows for column in columns]
+    rotated = rotate_batch(tokens, KEY, CRYPTO_MODE)
+
+    # Each value is only replaced if it's still the token that was read. Anything the app wrote in
+    # the meantime is already encrypted with the new key and is left alone
+    updated = 0
+    with db.engine.begin() as connection:
+        for i, column in enumerate(columns):
+            values = [
+                {"row_id": row.id, "old": token, "new": new}
+                for row, token, new in zip(rows, tokens[i::len(columns)], rotated[i::len(columns)])
+                if token is not None
+                ]
+            if values:
+                result = connection.execute(
+                    table.update()
+                    .where((table.c.id == bindparam("row_id")) & (table.c[column] == bindparam("old")))
+                    .values({column: bindparam("new")}),
+                    values
+                    )
+                updated += result.rowcount
+
+    return updated
+
+
+def rotate(checkpoint_path, chunk_size, pause, rate):
+
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    for table, columns in COLUMNS.items():
+        last_id = checkpoint["tables"].get(table.name, 0)
+        if last_id:
+            print(f"{table.name}: resuming after id {last_id}")
+
+        total = 0
+        while True:
+            start = time.perf_counter()
+
+            # Keyset pagination by id, each chunk is its own short transaction
+            with db.engine.connect() as connection:
+                rows = connection.execute(
+                    table.select()
+                    .with_only_columns(table.c.id, *[table.c[column] for column in columns])
+                    .where(table.c.id > last_id)
+                    .order_by(table.c.id)
+                    .limit(chunk_size)
+                    ).all()
+            if not rows:
+                break
+
+            total += rotate_chunk(table, columns, rows)
+            last_id = rows[-1].id
+
+            # Progress is saved after every committed chunk, an interrupted run resumes from here.
+            # A chunk that was committed but not checkpointed is simply re-encrypted again
+            checkpoint["tables"][table.name] = last_id
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"{table.name}: re-encrypted {total} values, up to id {last_id}")
+
+            # Throttle, pause between chunks and stay under rate rows per second
+            elapsed = time.perf_counter() - start
+            delay = max(pause, len(rows) / rate - elapsed if rate else 0)
+            time.sleep(delay)
+
+    print("Done, every value is encrypted with SECRET_KEY. OLD_SECRET_KEYS can be removed once every worker has")
+    print("restarted with the new key and the cookie sessions made with the old key have expired")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Re-encrypt every stored value with SECRET_KEY, values can be encrypted with any of OLD_SECRET_KEYS"
+        )
+    parser.add_argument("--chunk-size", type=int, default=500, help="rows per chunk (default 500)")
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to pause between chunks (default 0.1)")
+    parser.add_argument("--rate", type=float, default=0, help="max rows per second, 0 for no limit (default)")
+    parser.add_argument(
+        "--checkpoint", default=os.path.join(app.instance_path, "rotate_keys.json"),
+        help="file the progress is saved in, the job resumes from it when run again"
+        )
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.checkpoint)), exist_ok=True)
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    try:
+        rotate(args.checkpoint, args.chunk_size, args.pause, args.rate)
+    except InvalidToken:
+        print("A value could not be decrypted with SECRET_KEY or any of OLD_SECRET_KEYS, is a key missing?")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    # Queries require an application context, since there's no request, create one
+    with app.app_context():
+        main()
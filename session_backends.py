@@ -0,0 +1,330 @@
+import logging
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from cryptography.fernet import InvalidToken
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from flask.sessions import SessionInterface, SecureCookieSession, session_json_serializer
+from flask_session.sessions import ServerSideSession
+from db_models import SessionRecord
+
+
+def utcnow():
+
+    # Session expiry times are stored as naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def purge_expired_sessions(engine, batch_size=1000):
+
+    # Delete expired sessions a batch at a time, each batch in its own short transaction so
+    # the table is never locked for long. Returns the number of sessions deleted
+    table = SessionRecord.__table__
+    deleted = 0
+    while True:
+        with engine.begin() as connection:
+            ids = connection.execute(
+                table.select().with_only_columns(table.c.id)
+                .where(table.c.expiry < utcnow())
+                .limit(batch_size)
+                ).scalars().all()
+            if not ids:
+                return deleted
+            connection.execute(table.delete().where(table.c.id.in_(ids)))
+            deleted += len(ids)
+
+
+class CookieSession(SecureCookieSession):
+
+    # Same as Flask's cookie session, except a session that only holds the permanent flag is empty
+    def __bool__(self):
+        return bool(dict(self)) and self.keys() != {"_permanent"}
+
+
+class EncryptedCookieSessionInterface(SessionInterface):
+
+    # Keeps the whole session in a cookie, encrypted and signed with Fernet, so nothing is stored
+    # on the server. Flask's default cookie sessions are signed but readable by the client.
+    # Expiry is enforced with the timestamp inside the Fernet token
+
+    session_class = CookieSession
+    serializer = session_json_serializer
+
+    def __init__(self, key, permanent=True):
+        self.key = key
+        self.permanent = permanent
+
+    def new_session(self):
+        session = self.session_class()
+        session.permanent = self.permanent
+        session.modified = False
+        return session
+
+    def open_session(self, app, request):
+
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return self.new_session()
+
+        # Tokens older than the session lifetime are rejected, along with anything tampered with
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            data = self.serializer.loads(self.key.decrypt(cookie.encode(), ttl=ttl).decode())
+        except (InvalidToken, UnicodeError, ValueError):
+            return self.new_session()
+
+        return self.session_class(data)
+
+    def save_session(self, app, session, response):
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # If the session was cleared, tell the browser to delete the cookie
+        if not session:
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        cookie = self.key.encrypt(self.serializer.dumps(dict(session)).encode()).decode()
+        response.set_cookie(
+            name,
+            cookie,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+
+class CachedSessionInterface(SessionInterface):
+
+    # Server side sessions stored in the user_sessions table, fronted by a bounded in-process LRU cache.
+    # A session read from the database is kept for cache_ttl seconds (at most cache_size sessions), so a
+    # logout or login through another worker process takes effect in this one within cache_ttl seconds,
+    # this process's own writes update the cache straight away. cache_size=0 or cache_ttl=0 reads the
+    # database on every request. Nothing is written when the session didn't change. When the contents change (logging in or out) the
+    # session is written before the response is sent. When only the stored expiry is more than touch_interval
+    # seconds behind, the new expiry is queued and flushed in one transaction after the response has been
+    # sent (write-behind). Queued expiries only ever update an existing row, so they can't bring back a session
+    # that was deleted in the meantime or overwrite newer contents
+
+    session_class = ServerSideSession
+    serializer = session_json_serializer
+
+    def __init__(self, db, permanent=True, cache_size=10000, cache_ttl=5, touch_interval=3600,
+                 cleanup_interval=300, cleanup_batch=1000):
+        self.db = db
+        self.permanent = permanent
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.touch_interval = touch_interval
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+
+        # sid -> (serialized data, stored expiry, monotonic time it was cached)
+        self._cache = OrderedDict()
+
+        # sid -> expiry, for sessions whose stored expiry should be pushed forward
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+        self._engine = None
+
+    def _load(self, sid):
+
+        # (serialized data, stored expiry) of a session, or None. Served from the cache while it's fresh
+        with self._lock:
+            cached = self._cache.get(sid)
+            if cached is not None and time.monotonic() - cached[2] < self.cache_ttl:
+                self._cache.move_to_end(sid)
+                return cached[0], cached[1]
+
+        table = SessionRecord.__table__
+        row = self.db.session.execute(
+            table.select().with_only_columns(table.c.data, table.c.expiry).where(table.c.session_id == sid)
+            ).one_or_none()
+        if row is None:
+            self._cache_set(sid, None)
+            return None
+
+        stored = row.data.decode(), row.expiry
+        self._cache_set(sid, stored)
+        return stored
+
+    def _cache_set(self, sid, stored):
+
+        # Cache (data, expiry) of a session, or forget it when stored is None. The least recently
+        # used sessions are dropped once there are more than cache_size
+        with self._lock:
+            if stored is None or not self.cache_size or not self.cache_ttl:
+                self._cache.pop(sid, None)
+                return
+
+            self._cache[sid] = (stored[0], stored[1], time.monotonic())
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def open_session(self, app, request):
+
+        # The engine is needed to write outside of the request's database session and to flush after
+        # the app context is gone
+        if self._engine is None:
+            self._engine = self.db.engine
+
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self._load(sid)
+            if stored is not None and stored[1] > utcnow():
+                try:
+                    session = self.session_class(self.serializer.loads(stored[0]), sid=sid)
+                except ValueError:
+                    pass
+                else:
+                    session.stored = stored
+                    return session
+
+        # No cookie, unknown or expired session, start a new one
+        session = self.session_class(sid=secrets.token_urlsafe(32), permanent=self.permanent)
+        session.stored = None
+        return session
+
+    def save_session(self, app, session, response):
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        stored = getattr(session, "stored", None)
+
+        # If the session was cleared, delete it and tell the browser to delete the cookie
+        if not session:
+            if session.modified:
+                if stored is not None:
+                    self._write(session.sid, None)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Sessions that aren't permanent still need an expiry for the database, use the lifetime
+        expiry = (self.get_expiration_time(app, session) or datetime.now(timezone.utc) + app.permanent_session_lifetime)
+        expiry = expiry.replace(tzinfo=None)
+        data = self.serializer.dumps(dict(session))
+
+        # Changed contents are written now, so the next request sees them whichever process serves it.
+        # Unchanged sessions only get their stored expiry pushed forward once in a while, after the response
+        if stored is None or stored[0] != data:
+            self._write(session.sid, (data, expiry))
+            response.call_on_close(self.flush)
+        elif (expiry - stored[1]).total_seconds() > self.touch_interval:
+            with self._lock:
+                self._pending[session.sid] = expiry
+            response.call_on_close(self.flush)
+
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
+
+    def _write(self, sid, value):
+
+        # Write (data, expiry) of a session, or delete it when value is None, in its own transaction.
+        # A queued expiry for the session is dropped, the write already has a newer one
+        with self._lock:
+            self._pending.pop(sid, None)
+
+        table = SessionRecord.__table__
+        with self._engine.begin() as connection:
+            if value is None:
+                connection.execute(table.delete().where(table.c.session_id == sid))
+            else:
+                data, expiry = value
+                updated = connection.execute(
+                    table.update().where(table.c.session_id == sid).values(data=data.encode(), expiry=expiry)
+                    ).rowcount
+                if not updated:
+                    connection.execute(table.insert().values(session_id=sid, data=data.encode(), expiry=expiry))
+
+        # Only cached once the transaction has committed
+        self._cache_set(sid, value)
+
+    def flush(self):
+
+        # Called once the response has been sent
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+
+            try:
+                self._touch(pending)
+            except SQLAlchemyError:
+
+                # Put the expiries back in the queue (unless there's something newer) to retry on the next flush
+                logging.getLogger(__name__).exception("Could not write session expiries, will retry")
+                with self._lock:
+                    for sid, expiry in pending.items():
+                        self._pending.setdefault(sid, expiry)
+                return
+
+            # Clean up expired sessions every cleanup_interval seconds, rather than on each request
+            if time.monotonic() - self._last_cleanup > self.cleanup_interval:
+                self._last_cleanup = time.monotonic()
+                purge_expired_sessions(self._engine, self.cleanup_batch)
+
+    def _touch(self, pending):
+
+        # Push the stored expiry of every queued session forward in a single transaction (executemany).
+        # Rows that were deleted in the meantime are left deleted
+        if pending:
+            table = SessionRecord.__table__
+            with self._engine.begin() as connection:
+                connection.execute(
+                    table.update().where(table.c.session_id == bindparam("sid")).values(expiry=bindparam("new_expiry")),
+                    [{"sid": sid, "new_expiry": expiry} for sid, expiry in pending.items()]
+                    )
+
+            # Cached copies get the new expiry too, otherwise they'd keep queueing it until they expire
+            with self._lock:
+                for sid, expiry in pending.items():
+                    cached = self._cache.get(sid)
+                    if cached is not None:
+                        self._cache[sid] = (cached[0], expiry, cached[2])
+
+
+def init_sessions(app, db, backend, key):
+
+    # Pick the session interface, "cached" (server side, unchanged sessions aren't written) or "cookie" (encrypted cookie)
+    if backend == "cookie":
+        app.session_interface = EncryptedCookieSessionInterface(key, app.config.get("SESSION_PERMANENT", True))
+    elif backend == "cached":
+        app.session_interface = CachedSessionInterface(
+            db,
+            permanent=app.config.get("SESSION_PERMANENT", True),
+            cache_size=app.config.get("SESSION_CACHE_SIZE", 10000),
+            cache_ttl=app.config.get("SESSION_CACHE_TTL", 5),
+            touch_interval=app.config.get("SESSION_TOUCH_INTERVAL", 3600),
+            cleanup_interval=app.config.get("SESSION_CLEANUP_INTERVAL", 300),
+            cleanup_batch=app.config.get("SESSION_CLEANUP_BATCH", 1000)
+            )
+    else:
+        raise ValueError(f"Unknown session backend: {backend}")
@@ -13,6 +13,12 @@ document.addEventListener("DOMContentLoaded", function () {
         dialogBox(dialog);
     }
 
+    // Load more budgets as the user scrolls to the bottom of the list
+    const loadMore = document.querySelector(".load-more");
+    if (loadMore) {
+        lazyLoadBudgets(loadMore, dialog);
+    }
+
     // Select the form
     const form = document.querySelector(".budget-form");
 
@@ -485,7 +491,8 @@ function formDataCollection(budgetName, budget, result, id) {
         result: result ? result : null,
         id: id ? id : null
         },
-        "categories": {}
+        "categories": {},
+        "ids": {}
     };
 
     // Select the input rows that were added by the user
@@ -543,6 +550,14 @@ function formDataCollection(budgetName, budget, result, id) {
 
             // Add users expense and cost as key value pairs to the object
             formData["categories"][categoryName][expense] = cost;
+
+            // Send back the id of saved expenses, so the server only has to update the ones that changed
+            if (input.dataset.expenseId) {
+                if (!formData["ids"].hasOwnProperty(categoryName)) {
+                    formData["ids"][categoryName] = {};
+                }
+                formData["ids"][categoryName][expense] = parseInt(input.dataset.expenseId);
+            }
         }
     }
 
@@ -577,26 +592,11 @@ function scrollToTop() {
 function dialogBox(dialog) {
     const showButtons = document.querySelectorAll("#delete");
     const cancelButton = document.querySelector("#cancel");
-    const inputDelete = document.querySelector("#modal-input");
-    const span = document.querySelector("dialog span");
     
     // For each delete button, get budget name and id associated with clicked button to
     // assign dataset contents to span and form input element, then show the modal
     showButtons.forEach((button) => {
-        button.addEventListener("click", () => {
-
-            // If it's for deleting a budget
-            if (dialog.id === "budgets") {
-                span.innerHTML = button.dataset.budgetName;
-                inputDelete.value = button.dataset.budgetId;
-            } 
-            
-            // If it's for deleting an account
-            else if (dialog.id == "account") {
-                span.innerHTML = "account";
-            }
-            dialog.showModal();
-        });
+        dialogButton(dialog, button);
     });
 
     // Close the modal if cancel button is clicked
@@ -621,6 +621,96 @@ function dialogBox(dialog) {
     });
 }
 
+/* Show the dialog when a delete button is clicked */
+function dialogButton(dialog, button) {
+    const inputDelete = document.querySelector("#modal-input");
+    const span = document.querySelector("dialog span");
+
+    button.addEventListener("click", () => {
+
+        // If it's for deleting a budget
+        if (dialog.id === "budgets") {
+            span.textContent = button.dataset.budgetName;
+            inputDelete.value = button.dataset.budgetId;
+        } 
+        
+        // If it's for deleting an account
+        else if (dialog.id == "account") {
+            span.innerHTML = "account";
+        }
+        dialog.showModal();
+    });
+}
+
+/* Fetch the next page of budgets when the element scrolls into view */
+// https://developer.mozilla.org/en-US/docs/Web/API/Intersection_Observer_API
+function lazyLoadBudgets(loadMore, dialog) {
+    const list = document.querySelector(".budget-list");
+    let loading = false;
+
+    const observer = new IntersectionObserver(async (entries) => {
+        if (!entries[0].isIntersecting || loading) {
+            return;
+        }
+        loading = true;
+
+        // Get the page after the cursor
+        const request = await fetch(`${loadMore.dataset.url}?after=${encodeURIComponent(loadMore.dataset.next)}`);
+        if (!request.ok) {
+            observer.disconnect();
+            return;
+        }
+        const response = await request.json();
+
+        // Build the list items the same way as the template does
+        response.budgets.forEach((budget) => {
+            const div = document.createElement("div");
+            div.classList.add("list");
+
+            const item = document.createElement("div");
+            item.classList.add("list-item");
+
+            const link = document.createElement("a");
+            link.href = budget.url;
+            link.dataset.dateTime = budget.date;
+
+            const name = document.createElement("div");
+            name.classList.add("list-name");
+            name.textContent = budget.name;
+
+            const date = document.createElement("div");
+            date.classList.add("list-date");
+            date.textContent = budget.date;
+
+            const button = document.createElement("button");
+            button.classList.add("btn-delete");
+            button.id = "delete";
+            button.dataset.budgetId = budget.id;
+            button.dataset.budgetName = budget.name;
+            button.innerHTML = '<i class="fa-regular fa-trash-can"></i>';
+            dialogButton(dialog, button);
+
+            link.appendChild(name);
+            link.appendChild(date);
+            item.appendChild(link);
+            div.appendChild(item);
+            div.appendChild(button);
+            list.appendChild(div);
+        });
+
+        // Stop once there are no more pages
+        if (response.next) {
+            loadMore.dataset.next = response.next;
+        } else {
+            observer.disconnect();
+            loadMore.remove();
+        }
+        loading = false;
+    });
+
+    observer.observe(loadMore);
+}
+
 /* Provide feedback when user hits max character limit for budget name or expense names */
 function inputMax(input) {
 
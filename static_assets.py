@@ -0,0 +1,115 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+
+from flask import request, send_from_directory
+
+
+# Precompressed variants written by build_static.py, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# A year, versioned static URLs never change so they can be cached for as long as browsers allow
+FAR_FUTURE = 365 * 24 * 3600
+
+# Dynamic responses of these types are compressed when they're big enough
+COMPRESSIBLE = {"text/html", "application/json", "text/csv", "text/plain", "application/x-ndjson"}
+
+
+def fingerprint(path):
+
+    # Short hash of the file contents, it changes whenever the file does
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+class StaticAssets:
+
+    # Content hashed static URLs (url_for("static", ...) adds ?v=<hash>), served with a far-future
+    # Cache-Control and as a precompressed variant when the client accepts one. Also gzips dynamic
+    # HTML/JSON responses of at least gzip_min_size bytes
+    # https://flask.palletsprojects.com/en/3.0.x/api/#flask.Flask.url_defaults
+
+    def __init__(self, app=None, gzip_min_size=1024, gzip_level=6):
+        self.gzip_min_size = gzip_min_size
+        self.gzip_level = gzip_level
+        self.hashes = {}
+        self.variants = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.static_folder
+        self.scan()
+
+        app.url_defaults(self.add_version)
+        app.view_functions["static"] = self.send_static
+        app.after_request(self.compress)
+        app.extensions["static_assets"] = self
+
+    def scan(self):
+
+        # Hash every static file once at startup, and note which compressed variants are up to date
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                    continue
+
+                filename = os.path.relpath(path, self.folder).replace(os.sep, "/")
+                self.hashes[filename] = fingerprint(path)
+
+                # A variant older than its file is left over from a previous build, so it isn't used
+                self.variants[filename] = [
+                    (encoding, suffix) for encoding, suffix in ENCODINGS
+                    if os.path.exists(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+                    ]
+
+    def add_version(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.hashes:
+            values.setdefault("v", self.hashes[values["filename"]])
+
+    def send_static(self, filename):
+
+        # Only the current version can be cached for good, other requests are revalidated (ETag)
+        versioned = filename in self.hashes and request.args.get("v") == self.hashes[filename]
+
+        encoding, suffix = next(
+            ((encoding, suffix) for encoding, suffix in self.variants.get(filename, []) if request.accept_encodings[encoding]),
+            (None, "")
+            )
+        response = send_from_directory(
+            self.folder, filename + suffix, mimetype=mimetypes.guess_type(filename)[0],
+            max_age=FAR_FUTURE if versioned else None
+            )
+
+        if versioned:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        if self.variants.get(filename):
+            response.vary.add("Accept-Encoding")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+
+        return response
+
+    def compress(self, response):
+
+        # Files (send_file) and streamed responses are left alone, so are ones that are already encoded
+        if response.mimetype not in COMPRESSIBLE or response.direct_passthrough or response.is_streamed \
+                or response.status_code < 200 or response.status_code in (204, 206) or "Content-Encoding" in response.headers:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        if not request.accept_encodings["gzip"] or response.calculate_content_length() < self.gzip_min_size:
+            return response
+
+        response.set_data(gzip.compress(response.get_data(), self.gzip_level))
+        response.headers["Content-Encoding"] = "gzip"
+
+        # The compressed body is a different representation, so a strong ETag no longer applies
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        return response
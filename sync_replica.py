@@ -0,0 +1,51 @@
+import os
+import time
+import sqlite3
+import argparse
+
+from sqlalchemy import make_url
+from dotenv import load_dotenv
+
+
+def sqlite_path(url):
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        raise SystemExit("Only SQLite databases can be copied, use the database's own replication otherwise")
+    return url.database
+
+
+def copy(primary, replica):
+
+    # Copy the whole primary into the replica file, consistent even while the app is writing
+    # https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.backup
+    source = sqlite3.connect(primary)
+    target = sqlite3.connect(replica)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def main():
+
+    # Stand in for replication when trying out DATABASE_REPLICA_URL locally with two SQLite files,
+    # the interval is how far behind the primary the replica gets
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Copy the SQLite DATABASE_URL to DATABASE_REPLICA_URL")
+    parser.add_argument("--interval", type=float, default=0, help="keep copying every this many seconds (default once)")
+    args = parser.parse_args()
+
+    primary = sqlite_path(os.getenv("DATABASE_URL"))
+    replica = sqlite_path(os.getenv("DATABASE_REPLICA_URL"))
+
+    while True:
+        copy(primary, replica)
+        print(f"Copied {primary} to {replica}")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
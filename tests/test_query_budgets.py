@@ -0,0 +1,38 @@
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+from cryptography.fernet import Fernet
+
+# Always a throwaway SQLite database and key, whatever is in the environment or the .env file.
+# These need to be set before app is imported
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["SECRET_KEY"] = Fernet.generate_key().decode()
+
+# The routes are driven by the load test in the benchmarks folder
+root = os.path.join(os.path.dirname(__file__), "..")
+sys.path[:0] = [root, os.path.join(root, "benchmarks")]
+
+import load_test
+from load_test import QUERY_BUDGETS, server_timing
+from seed import seed
+
+
+@pytest.fixture(scope="module")
+def samples():
+
+    # Every route a few times with a small seeded user, the query counts don't depend on the amount of data
+    users = seed(users=1, budgets=3, expenses=10)
+    return load_test.run(load_test.TestClientDriver(), users, requests=2, expenses=10, rng=random.Random(0))
+
+
+@pytest.mark.parametrize("route", QUERY_BUDGETS)
+def test_query_budget(samples, route):
+    assert route in samples, f"{route} wasn't requested"
+    for status, _, header, _ in samples[route]:
+        assert status < 400
+        _, queries = server_timing(header)
+        assert queries is not None, f"{route} has no query count"
+        assert queries <= QUERY_BUDGETS[route], f"{route} issued {queries} queries, the most it may issue is {QUERY_BUDGETS[route]}"